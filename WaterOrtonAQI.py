@@ -1,16 +1,34 @@
 #!/usr/bin/env python3
 import os
 import requests
-from datetime import datetime
+from requests.adapters import HTTPAdapter
+from datetime import datetime, timedelta, timezone
+from array import array
+from bisect import bisect_right
+from email.utils import parsedate_to_datetime
+from concurrent.futures import ThreadPoolExecutor, wait
+from collections import deque
+from contextlib import contextmanager
+import argparse
+import gzip
+import hashlib
+import json
+import math
 import random
+import re
+import sched
+import sqlite3
+import sys
+import threading
+import time
 import tweepy
 import logging
 
 # --- Dynamic Tweet Pools ---
 
-def get_time_of_day():
-    """Returns 'this morning', 'this lunchtime', or 'this evening' based on current time."""
-    hour = datetime.now().hour
+def get_time_of_day(now=None):
+    """Returns 'this morning', 'this lunchtime', or 'this evening' based on current time (or `now`)."""
+    hour = (now or datetime.now()).hour
     if 7 <= hour < 12:
         return "this morning"
     elif 12 <= hour < 15:
@@ -22,13 +40,13 @@ def get_time_of_day():
 
 TEMPLATES = {
     "low": [
-        "🍃 Low pollution: The air in Water Orton is fresh and clean {time_of_day}. A great day for outdoor activities.",
-        "🍃 Low pollution: Water Orton is enjoying excellent air quality {time_of_day}. Perfect for a morning jog or walk.",
-        "🍃 Low pollution: Crisp air and clear skies in Water Orton make {time_of_day} ideal for outdoor plans.",
-        "🍃 Low pollution: With pristine air in Water Orton {time_of_day}, it's a wonderful time to enjoy nature.",
-        "🍃 Low pollution: Water Orton's air is perfect {time_of_day}. Take a deep breath and enjoy the fresh conditions.",
-        "🍃 Low pollution: Clear and clean air surrounds Water Orton {time_of_day}. A fantastic day to be outdoors.",
-        "🍃 Low pollution: The air quality in Water Orton is as good as it gets {time_of_day}. Time to make the most of it.",
+        "🍃 Low pollution: The air in {locality} is fresh and clean {time_of_day}. A great day for outdoor activities.",
+        "🍃 Low pollution: {locality} is enjoying excellent air quality {time_of_day}. Perfect for a morning jog or walk.",
+        "🍃 Low pollution: Crisp air and clear skies in {locality} make {time_of_day} ideal for outdoor plans.",
+        "🍃 Low pollution: With pristine air in {locality} {time_of_day}, it's a wonderful time to enjoy nature.",
+        "🍃 Low pollution: {locality}'s air is perfect {time_of_day}. Take a deep breath and enjoy the fresh conditions.",
+        "🍃 Low pollution: Clear and clean air surrounds {locality} {time_of_day}. A fantastic day to be outdoors.",
+        "🍃 Low pollution: The air quality in {locality} is as good as it gets {time_of_day}. Time to make the most of it.",
         "🍃 Low pollution: Fresh air and sunshine make {time_of_day} perfect for outdoor fun.",
         "🍃 Low pollution: Excellent air conditions {time_of_day} mean it's a great time to connect with nature.",
         "🍃 Low pollution: The air feels crisp and clean {time_of_day}. Perfect for exploring the outdoors.",
@@ -44,13 +62,13 @@ TEMPLATES = {
         "🍃 Low pollution: Such crisp air {time_of_day} makes for a beautiful day to enjoy nature. "
     ],
     "mediocre": [
-        "⚠️ Moderate pollution: Water Orton's air quality is moderate {time_of_day}. Sensitive individuals may want to stay indoors.",
-        "⚠️ Moderate pollution: Air quality in Water Orton is fair but manageable {time_of_day}. Take precautions if spending time outdoors.",
-        "⚠️ Moderate pollution: Moderate pollution in Water Orton means {time_of_day} is better for shorter outdoor activities.",
-        "⚠️ Moderate pollution: Water Orton's air is hovering in the moderate range {time_of_day}. Limit exposure if sensitive.",
-        "⚠️ Moderate pollution: Conditions in Water Orton are fair {time_of_day}—consider breaks indoors during outdoor plans.",
-        "⚠️ Moderate pollution: {time_of_day}'s air quality in Water Orton isn't perfect, but it's manageable for most.",
-        "⚠️ Moderate pollution: If sensitive to pollution, take it slow in Water Orton {time_of_day} as conditions are mediocre.",
+        "⚠️ Moderate pollution: {locality}'s air quality is moderate {time_of_day}. Sensitive individuals may want to stay indoors.",
+        "⚠️ Moderate pollution: Air quality in {locality} is fair but manageable {time_of_day}. Take precautions if spending time outdoors.",
+        "⚠️ Moderate pollution: Moderate pollution in {locality} means {time_of_day} is better for shorter outdoor activities.",
+        "⚠️ Moderate pollution: {locality}'s air is hovering in the moderate range {time_of_day}. Limit exposure if sensitive.",
+        "⚠️ Moderate pollution: Conditions in {locality} are fair {time_of_day}—consider breaks indoors during outdoor plans.",
+        "⚠️ Moderate pollution: {time_of_day}'s air quality in {locality} isn't perfect, but it's manageable for most.",
+        "⚠️ Moderate pollution: If sensitive to pollution, take it slow in {locality} {time_of_day} as conditions are mediocre.",
         "⚠️ Moderate pollution: Moderate air quality {time_of_day}—light outdoor activities are fine, but pace yourself.",
         "⚠️ Moderate pollution: Conditions are fair {time_of_day}, but prolonged exposure outdoors may cause discomfort.",
         "⚠️ Moderate pollution: Average pollution levels persist {time_of_day}—sensitive groups should take it easy.",
@@ -66,13 +84,13 @@ TEMPLATES = {
         "⚠️ Moderate pollution: Moderate air conditions {time_of_day} mean light outdoor activities are ideal."
     ],
     "high": [
-        "🚨 High pollution: Air quality in Water Orton is poor {time_of_day}. Limit outdoor plans where possible.",
-        "🚨 High pollution: Pollution levels are elevated in Water Orton {time_of_day}—take precautions and reduce exposure.",
-        "🚨 High pollution: Water Orton's air {time_of_day} is unhealthy. Masks are recommended for outdoor activities.",
-        "🚨 High pollution: Poor air quality in Water Orton {time_of_day} means sensitive groups should stay indoors.",
-        "🚨 High pollution: Pollution in Water Orton is concerning {time_of_day}—plan your day with safety in mind.",
-        "🚨 High pollution: {time_of_day}'s air is unhealthy in Water Orton. Avoid exertion and limit exposure outside.",
-        "🚨 High pollution: If you're sensitive to pollution, Water Orton's air {time_of_day} requires extra precautions.",
+        "🚨 High pollution: Air quality in {locality} is poor {time_of_day}. Limit outdoor plans where possible.",
+        "🚨 High pollution: Pollution levels are elevated in {locality} {time_of_day}—take precautions and reduce exposure.",
+        "🚨 High pollution: {locality}'s air {time_of_day} is unhealthy. Masks are recommended for outdoor activities.",
+        "🚨 High pollution: Poor air quality in {locality} {time_of_day} means sensitive groups should stay indoors.",
+        "🚨 High pollution: Pollution in {locality} is concerning {time_of_day}—plan your day with safety in mind.",
+        "🚨 High pollution: {time_of_day}'s air is unhealthy in {locality}. Avoid exertion and limit exposure outside.",
+        "🚨 High pollution: If you're sensitive to pollution, {locality}'s air {time_of_day} requires extra precautions.",
         "🚨 High pollution: Poor air quality persists {time_of_day}—stay safe and minimize time outdoors.",
         "🚨 High pollution: High pollution levels {time_of_day} call for reduced outdoor exposure and frequent breaks indoors.",
         "🚨 High pollution: {time_of_day}'s air isn't healthy—consider masks and air purifiers if necessary.",
@@ -88,13 +106,13 @@ TEMPLATES = {
         "🚨 High pollution: Protect your health {time_of_day}—reduce outdoor exposure and consider indoor alternatives."
     ],
     "emergency": [
-        "🚨 Dangerous air pollution levels detected in Water Orton {time_of_day}—avoid outdoor exposure entirely.🚨",
-        "🚨 Critical pollution persists in Water Orton {time_of_day}. Everyone is advised to stay indoors.🚨",
-        "🚨 Emergency alert for Water Orton—air quality is hazardous {time_of_day}. Limit all exposure immediately.🚨",
-        "🚨 Severe air conditions in Water Orton {time_of_day} pose significant health risks. Take care indoors.🚨",
-        "🚨 Water Orton's air {time_of_day} is dangerously unhealthy—close all windows and prioritize safety.🚨",
-        "🚨 Extremely high pollution levels in Water Orton {time_of_day} mean masks and air purifiers are essential.🚨",
-        "🚨 Hazardous air quality persists in Water Orton {time_of_day}. Remain vigilant and stay indoors.🚨",
+        "🚨 Dangerous air pollution levels detected in {locality} {time_of_day}—avoid outdoor exposure entirely.🚨",
+        "🚨 Critical pollution persists in {locality} {time_of_day}. Everyone is advised to stay indoors.🚨",
+        "🚨 Emergency alert for {locality}—air quality is hazardous {time_of_day}. Limit all exposure immediately.🚨",
+        "🚨 Severe air conditions in {locality} {time_of_day} pose significant health risks. Take care indoors.🚨",
+        "🚨 {locality}'s air {time_of_day} is dangerously unhealthy—close all windows and prioritize safety.🚨",
+        "🚨 Extremely high pollution levels in {locality} {time_of_day} mean masks and air purifiers are essential.🚨",
+        "🚨 Hazardous air quality persists in {locality} {time_of_day}. Remain vigilant and stay indoors.🚨",
         "🚨 Critical air pollution levels {time_of_day} require everyone to limit outdoor exposure entirely.🚨",
         "🚨 Severe conditions {time_of_day} mean everyone should remain indoors for safety.🚨",
         "🚨 Avoid outdoor exertion {time_of_day}—air quality poses serious health risks today.🚨",
@@ -126,11 +144,11 @@ FACTS = [
     "Pollutant Information: - Particulate matter pollution is linked to cardiovascular diseases and reduced life expectancy.",
     "Pollutant Information: - PM2.5 is commonly generated by burning fossil fuels such as coal, oil, and wood.",
     # Thresholds and Standards (10 facts)
-    "Pollutant Thresholds: - DEFRA thresholds for PM2.5 are: moderate >12 µg/m³, high >24 µg/m³, and emergency >36 µg/m³.",
+    "Pollutant Thresholds: - DEFRA's Daily Air Quality Index bands for 24-hour mean PM2.5 are: moderate from 36 µg/m³, high from 54 µg/m³, and very high from 71 µg/m³.",
     "Pollutant Thresholds: - WHO guidelines recommend stricter limits for PM2.5: an annual average <5 µg/m³ and a daily limit <15 µg/m³.",
-    "Pollutant Thresholds: - DEFRA thresholds for PM10 are: moderate >17 µg/m³, high >34 µg/m³, and emergency >50 µg/m³.",
+    "Pollutant Thresholds: - DEFRA's Daily Air Quality Index bands for 24-hour mean PM10 are: moderate from 51 µg/m³, high from 76 µg/m³, and very high from 101 µg/m³.",
     "Pollutant Thresholds: - WHO suggests that PM10 should not exceed 45 µg/m³ daily to maintain safe air quality.",
-    "Pollutant Thresholds: - DEFRA's threshold for NO2 is: moderate >67 µg/m³, high >134 µg/m³, and emergency >200 µg/m³.",
+    "Pollutant Thresholds: - DEFRA's Daily Air Quality Index bands for hourly NO2 are: moderate from 201 µg/m³, high from 401 µg/m³, and very high from 601 µg/m³.",
     "Pollutant Thresholds: - DEFRA standards are tailored for UK conditions, reflecting local air quality challenges.",
     "Pollutant Thresholds: - WHO thresholds are based on comprehensive global research aimed at protecting public health.",
     "Be Aware : Emergency air pollution levels signal an immediate health risk requiring urgent action.",
@@ -189,121 +207,1489 @@ SENSORS = [
     {"id": 118484, "name": "Watton Lane"}
 ]
 
-def get_air_quality(sensor):
+# --- Localities ---
+# One process can serve many towns. LOCALITIES_CONFIG points at a JSON file:
+#   {"localities": [{
+#       "name": "water-orton",              unique key, used in logs and the outbox
+#       "display_name": "Water Orton",      substituted for {locality} in templates
+#       "sensors": [{"id": 118480, "name": "Birmingham Road"}, ...],
+#       "templates": "templates/water-orton.json",   optional, same shape as TEMPLATES
+#       "schedule": [{"name": "morning", "time": "08:00", "job": "sensor"}, ...],  optional
+#       "account": "WATER_ORTON"            optional prefix for the four TWITTER_* variables
+#       "location": {"lat": 52.518, "lng": -1.742},   optional, discover sensors instead
+#       "radius_km": 3, "max_sensors": 10   discovery limits (defaults shown)
+#   }]}
+# Localities with a location use the nearest active installations, resolved
+# just before each fetch and re-downloaded every DISCOVERY_REFRESH seconds;
+# their "sensors" list is only a fallback. Loading the file never hits the network.
+# Without the file, the bot serves Water Orton with the settings in this module.
+LOCALITIES_CONFIG = os.getenv('LOCALITIES_CONFIG', "localities.json")
+
+def _load_templates(path):
+    with open(path, encoding="utf-8") as f:
+        templates = json.load(f)
+    missing = [level for level in TEMPLATES if not templates.get(level)]
+    if missing:
+        raise ValueError(f"Template file {path} has no templates for: {', '.join(missing)}")
+    return templates
+
+def load_localities(path=None):
     """
-    Fetches air quality data from the Airly API for a single sensor.
-    Returns a dictionary containing specific pollutants for tweet logic.
+    Reads the locality configuration, filling in defaults from this module
+    for anything a locality leaves out. Returns a list of locality dicts.
     """
-    sensor_id = sensor["id"]
-    url = f"https://airapi.airly.eu/v2/measurements/installation?installationId={sensor_id}"
-    headers = {"apikey": AIRLY_API_KEY}
+    path = path or LOCALITIES_CONFIG
+    if not os.path.exists(path):
+        return [{
+            "name": "water-orton",
+            "display_name": "Water Orton",
+            "sensors": SENSORS,
+            "templates": TEMPLATES,
+            "schedule": TWEET_SCHEDULE,
+            "account": None,
+        }]
+
+    with open(path, encoding="utf-8") as f:
+        config = json.load(f)
+    localities = []
+    for entry in config["localities"]:
+        templates = entry.get("templates")
+        locality = {
+            "name": entry["name"],
+            "display_name": entry.get("display_name", entry["name"]),
+            "sensors": entry.get("sensors", []),
+            "templates": _load_templates(templates) if isinstance(templates, str) else templates or TEMPLATES,
+            "schedule": entry.get("schedule", TWEET_SCHEDULE),
+            "account": entry.get("account"),
+        }
+        if entry.get("location"):
+            locality["location"] = entry["location"]
+            locality["radius_km"] = entry.get("radius_km", 3)
+            locality["max_sensors"] = entry.get("max_sensors", 10)
+            locality["configured_sensors"] = locality["sensors"]
+        localities.append(locality)
+    return localities
+
+# --- Instrumentation ---
+# Per-stage timers and counters for the fetch -> classify -> post pipeline.
+# Timers keep their last METRICS_MAX_SAMPLES durations for percentiles, plus a
+# total count and sum. Set METRICS_PATH to write them after every run, as JSON
+# or (for paths ending in .prom) Prometheus text format.
+METRICS_PATH = os.getenv('METRICS_PATH', "")
+METRICS_MAX_SAMPLES = 10000
+METRICS_QUANTILES = (0.5, 0.9, 0.99)
+
+_metrics_lock = threading.Lock()
+_counters = {}
+_timers = {}
+
+def increment(name, amount=1):
+    with _metrics_lock:
+        _counters[name] = _counters.get(name, 0) + amount
+
+def observe(stage, seconds):
+    with _metrics_lock:
+        timer = _timers.get(stage)
+        if timer is None:
+            timer = _timers[stage] = {"count": 0, "sum": 0.0, "samples": deque(maxlen=METRICS_MAX_SAMPLES)}
+        timer["count"] += 1
+        timer["sum"] += seconds
+        timer["samples"].append(seconds)
+
+@contextmanager
+def timed(stage):
+    """
+    Times the enclosed block and records it under `stage`, even if it raises.
+    """
+    start = time.perf_counter()
     try:
-        response = requests.get(url, headers=headers, timeout=10)
-        response.raise_for_status()
-        data = response.json()
-        current_values = data.get("current", {}).get("values", [])
+        yield
+    finally:
+        observe(stage, time.perf_counter() - start)
 
-        # Extract specific pollutants for tweet logic
-        pm25 = next((x["value"] for x in current_values if x["name"] == "PM2.5"), None)
-        pm10 = next((x["value"] for x in current_values if x["name"] == "PM10"), None)
-        no2 = next((x["value"] for x in current_values if x["name"] == "NO2"), None)
-        no = next((x["value"] for x in current_values if x["name"] == "NO"), None)
-        pollutants_tweet = {"PM2.5": pm25, "PM10": pm10, "NO2": no2, "NO": no}
+def reset_metrics():
+    with _metrics_lock:
+        _counters.clear()
+        _timers.clear()
 
+def metrics_snapshot():
+    """
+    Returns {"counters": {...}, "timers": {stage: {count, sum, max, p50, p90, p99}}}.
+    """
+    with _metrics_lock:
+        counters = dict(_counters)
+        timers = {stage: (t["count"], t["sum"], sorted(t["samples"])) for stage, t in _timers.items()}
+    summary = {}
+    for stage, (count, total, samples) in timers.items():
+        summary[stage] = {"count": count, "sum": total, "max": samples[-1] if samples else 0.0}
+        for q in METRICS_QUANTILES:
+            summary[stage][f"p{int(q * 100)}"] = samples[min(len(samples) - 1, int(q * len(samples)))] if samples else 0.0
+    return {"counters": counters, "timers": summary}
 
+def format_metrics_prometheus(snapshot=None):
+    """
+    Renders a metrics snapshot in the Prometheus text exposition format.
+    """
+    snapshot = snapshot or metrics_snapshot()
+    lines = []
+    for name, value in sorted(snapshot["counters"].items()):
+        lines.append(f"# TYPE aqi_{name}_total counter")
+        lines.append(f"aqi_{name}_total {value}")
+    if snapshot["timers"]:
+        lines.append("# TYPE aqi_stage_seconds summary")
+    for stage, timer in sorted(snapshot["timers"].items()):
+        for q in METRICS_QUANTILES:
+            lines.append(f'aqi_stage_seconds{{stage="{stage}",quantile="{q}"}} {timer[f"p{int(q * 100)}"]:.6f}')
+        lines.append(f'aqi_stage_seconds_sum{{stage="{stage}"}} {timer["sum"]:.6f}')
+        lines.append(f'aqi_stage_seconds_count{{stage="{stage}"}} {timer["count"]}')
+    return "\n".join(lines) + "\n"
 
-        # Return  pollutants for tweet
-        return {
-            "sensor_name": sensor["name"],
-            "pollutants_tweet": {k: v for k, v in pollutants_tweet.items() if v is not None},
-        }
+def write_metrics(path=None):
+    path = path or METRICS_PATH
+    if not path:
+        return
+    snapshot = metrics_snapshot()
+    with open(path, "w", encoding="utf-8") as f:
+        if path.endswith(".prom"):
+            f.write(format_metrics_prometheus(snapshot))
+        else:
+            json.dump(snapshot, f, indent=2)
+
+# --- Airly HTTP Settings ---
+AIRLY_API_URL = os.getenv('AIRLY_API_URL', "https://airapi.airly.eu")
+AIRLY_TIMEOUT = float(os.getenv('AIRLY_TIMEOUT', "10"))
+AIRLY_MAX_WORKERS = int(os.getenv('AIRLY_MAX_WORKERS', "8"))
+AIRLY_BATCH_DEADLINE = float(os.getenv('AIRLY_BATCH_DEADLINE', "30"))
+
+# --- Airly Measurement Cache ---
+# Airly only refreshes "current" values hourly, so responses are kept on disk
+# per installation and served without a network call while still fresh.
+AIRLY_CACHE_PATH = os.getenv('AIRLY_CACHE_PATH', "airly_cache.sqlite3")
+AIRLY_CACHE_TTL = int(os.getenv('AIRLY_CACHE_TTL', "1800"))
+AIRLY_CACHE_MAX_STALE = int(os.getenv('AIRLY_CACHE_MAX_STALE', "10800"))
+
+# When set, every measurement response used is appended to this JSONL file
+# (gzip-compressed if it ends in .gz) so it can be replayed later with --replay.
+AIRLY_RECORD_PATH = os.getenv('AIRLY_RECORD_PATH', "")
+
+# --- Measurement History Store ---
+# Every hourly value Airly returns (current and history) for the configured
+# pollutants is kept per installation and pollutant in one file per UTC year:
+# little-endian float32 slots at fixed hour-of-year offsets, NaN where no
+# reading exists. New readings are written in place, a full year is about
+# 35 KB per pollutant, and range queries read only the slots they cover.
+HISTORY_DIR = os.getenv('HISTORY_DIR', "airly_history")
+HISTORY_MIN_COVERAGE = 0.75  # DEFRA data-capture rule for averaged values
+
+# Airly reports PM2.5 as "PM25"; store it under the name used everywhere else.
+AIRLY_NAME_ALIASES = {"PM25": "PM2.5"}
+
+_airly_session = None
+_airly_session_lock = threading.Lock()
+
+def get_airly_session():
+    """
+    Returns the shared keep-alive session used for every Airly request.
+    The connection pool is sized to AIRLY_MAX_WORKERS so concurrent fetches
+    reuse their TCP+TLS connections instead of opening a new one per sensor.
+    """
+    global _airly_session
+    with _airly_session_lock:
+        if _airly_session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=AIRLY_MAX_WORKERS)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            session.headers.update({"apikey": AIRLY_API_KEY or "", "Accept": "application/json"})
+            _airly_session = session
+        return _airly_session
+
+_airly_cache_local = threading.local()
+_airly_cache_write_lock = threading.Lock()
+
+def _airly_cache_connect():
+    """
+    Returns this thread's connection to the measurement cache database,
+    opening it on first use. A new database is switched to WAL mode (which
+    persists in the file) so several bots sharing one API key can read the
+    cache concurrently, and gets its table.
+    """
+    conn = getattr(_airly_cache_local, "conn", None)
+    if conn is not None and _airly_cache_local.path == AIRLY_CACHE_PATH:
+        return conn
+    if conn is not None:
+        conn.close()
+    created = not os.path.exists(AIRLY_CACHE_PATH)
+    conn = sqlite3.connect(AIRLY_CACHE_PATH, timeout=10)
+    if created:
+        conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")  # a cache can lose its last writes on power loss
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS measurements ("
+        " installation_id INTEGER PRIMARY KEY,"
+        " fetched_at REAL NOT NULL,"
+        " expires_at REAL NOT NULL,"
+        " body TEXT NOT NULL)"
+    )
+    _airly_cache_local.conn = conn
+    _airly_cache_local.path = AIRLY_CACHE_PATH
+    return conn
+
+def read_cached_measurement(sensor_id, max_age=None):
+    """
+    Returns (body, fetched_at, is_fresh) for a cached installation response,
+    or None if nothing usable is cached. Entries older than max_age seconds
+    (AIRLY_CACHE_MAX_STALE by default) are ignored.
+    """
+    if not AIRLY_CACHE_PATH:
+        return None
+    max_age = AIRLY_CACHE_MAX_STALE if max_age is None else max_age
+    try:
+        row = _airly_cache_connect().execute(
+            "SELECT body, fetched_at, expires_at FROM measurements WHERE installation_id = ?",
+            (sensor_id,)
+        ).fetchone()
+    except sqlite3.Error as e:
+        logging.warning(f"Measurement cache unavailable: {e}")
+        return None
+    if row is None:
+        return None
+    body, fetched_at, expires_at = row
+    now = time.time()
+    if now - fetched_at > max_age:
+        return None
+    return body, fetched_at, now < expires_at
+
+def write_cached_measurement(sensor_id, body, ttl):
+    """
+    Stores the raw response body for an installation, replacing any older entry.
+    """
+    if not AIRLY_CACHE_PATH:
+        return
+    now = time.time()
+    try:
+        conn = _airly_cache_connect()
+        # One writer at a time in this process; SQLite's busy retries back off far longer.
+        with _airly_cache_write_lock, conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO measurements (installation_id, fetched_at, expires_at, body)"
+                " VALUES (?, ?, ?, ?)",
+                (sensor_id, now, now + ttl, body)
+            )
+    except sqlite3.Error as e:
+        logging.warning(f"Could not write measurement cache for sensor {sensor_id}: {e}")
+
+def _cache_ttl_from_headers(headers):
+    """
+    Works out how long a response may be served from cache. Airly's
+    Cache-Control max-age / Expires headers can only shorten AIRLY_CACHE_TTL,
+    and no-store / no-cache disable caching for that response.
+    """
+    ttl = AIRLY_CACHE_TTL
+    cache_control = headers.get("Cache-Control", "").lower()
+    if "no-store" in cache_control or "no-cache" in cache_control:
+        return 0
+    match = re.search(r"max-age=(\d+)", cache_control)
+    if match:
+        return min(ttl, int(match.group(1)))
+    expires = headers.get("Expires")
+    if expires:
+        try:
+            return max(0, min(ttl, int(parsedate_to_datetime(expires).timestamp() - time.time())))
+        except (TypeError, ValueError):
+            pass
+    return ttl
+
+# Earliest time the Airly API may be called again, shared by all fetch threads.
+_airly_rate_limit = {"blocked_until": 0.0}
+
+def _update_rate_limit(response):
+    """
+    Records Airly's X-RateLimit-* / Retry-After headers so the remaining
+    fetches of this process fall back to the cache instead of burning quota
+    on requests that would be refused.
+    """
+    headers = response.headers
+    now = time.time()
+    blocked_until = 0.0
+    if response.status_code == 429:
+        retry_after = headers.get("Retry-After", "60")
+        blocked_until = now + (int(retry_after) if retry_after.isdigit() else 60)
+    elif headers.get("X-RateLimit-Remaining-day") == "0":
+        blocked_until = (now // 86400 + 1) * 86400
+    elif headers.get("X-RateLimit-Remaining-minute") == "0":
+        blocked_until = now + 60
+    if blocked_until:
+        _airly_rate_limit["blocked_until"] = max(_airly_rate_limit["blocked_until"], blocked_until)
+        logging.warning(f"Airly rate limit reached; using cached data until {datetime.fromtimestamp(blocked_until)}.")
+
+def fetch_airly_measurements(sensor_id):
+    """
+    Returns the raw Airly measurement response body for one installation.
+    Fresh cache entries are served without a network call. When the API fails
+    or the rate limit is exhausted, a stale cache entry is used instead.
+    Raises requests.RequestException if neither is available.
+    """
+    with timed("cache_read"):
+        cached = read_cached_measurement(sensor_id)
+    if cached and cached[2]:
+        increment("airly_cache_hits")
+        return cached[0]
+    increment("airly_cache_misses")
+
+    try:
+        if time.time() < _airly_rate_limit["blocked_until"]:
+            increment("airly_rate_limited")
+            raise requests.RequestException("Airly rate limit exhausted")
+        url = f"{AIRLY_API_URL}/v2/measurements/installation?installationId={sensor_id}"
+        with timed("airly_http"):
+            response = get_airly_session().get(url, timeout=AIRLY_TIMEOUT)
+            body = response.text
+        _update_rate_limit(response)
+        response.raise_for_status()
     except requests.RequestException as e:
+        increment("airly_http_errors")
+        if cached:
+            increment("airly_cache_stale_hits")
+            logging.warning(f"Using cached data for sensor {sensor_id} from {datetime.fromtimestamp(cached[1])}: {e}")
+            return cached[0]
+        raise
+
+    ttl = _cache_ttl_from_headers(response.headers)
+    if ttl > 0:
+        with timed("cache_write"):
+            write_cached_measurement(sensor_id, body, ttl)
+    return body
+
+_history_lock = threading.Lock()
+_HISTORY_SLOT_BYTES = 4
+
+def parse_airly_time(value):
+    """
+    Converts an Airly ISO timestamp such as "2024-01-31T08:00:00.000Z" to epoch seconds.
+    """
+    return datetime.fromisoformat(value.replace("Z", "+00:00")).timestamp()
+
+def _history_path(sensor_id, pollutant, year):
+    return os.path.join(HISTORY_DIR, str(sensor_id), pollutant, f"{year}.f32")
+
+def _history_slot(timestamp):
+    """
+    Returns (year, hour of year) for an epoch time, in UTC.
+    """
+    moment = datetime.fromtimestamp(timestamp, timezone.utc)
+    year_start = datetime(moment.year, 1, 1, tzinfo=timezone.utc).timestamp()
+    return moment.year, int((timestamp - year_start) // 3600)
+
+def _read_history_slots(path, first, count):
+    """
+    Reads `count` hourly values starting at hour-of-year `first` from a year
+    file. Slots past the end of the file (or a missing file) are NaN.
+    """
+    values = array('f')
+    try:
+        with open(path, "rb") as f:
+            f.seek(first * _HISTORY_SLOT_BYTES)
+            values.frombytes(f.read(count * _HISTORY_SLOT_BYTES))
+    except FileNotFoundError:
+        pass
+    if sys.byteorder == "big":
+        values.byteswap()
+    values.extend([math.nan] * (count - len(values)))
+    return values
+
+def _write_history_slots(path, slots):
+    """
+    Writes {hour of year: value} into a year file in place, padding the file
+    with NaN up to the first new slot if it is shorter.
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "r+b" if os.path.exists(path) else "w+b") as f:
+        size = f.seek(0, os.SEEK_END) // _HISTORY_SLOT_BYTES
+        for hour in sorted(slots):
+            value = array('f', [math.nan] * max(0, hour - size) + [slots[hour]])
+            if sys.byteorder == "big":
+                value.byteswap()
+            f.seek(min(hour, size) * _HISTORY_SLOT_BYTES)
+            value.tofile(f)
+            size = max(size, hour + 1)
+
+def add_history_entry(sensor_id, entry, updates):
+    """
+    Adds the configured pollutants of one Airly history/current entry to a
+    pending {path: {hour of year: value}} update, to be written by
+    write_history_updates.
+    """
+    start = entry.get("fromDateTime")
+    if not start:
+        return
+    year, hour = _history_slot(parse_airly_time(start))
+    for item in entry.get("values", []):
+        value = item.get("value")
+        if value is None:
+            continue
+        pollutant = AIRLY_NAME_ALIASES.get(item["name"], item["name"])
+        if pollutant in POLLUTANT_FIELDS:
+            updates.setdefault(_history_path(sensor_id, pollutant, year), {})[hour] = value
+
+def write_history_updates(updates):
+    with _history_lock:
+        for path, slots in updates.items():
+            _write_history_slots(path, slots)
+
+def query_history(sensor_id, pollutant, start, end):
+    """
+    Returns the hourly series for one installation and pollutant between the
+    epoch times start (inclusive) and end (exclusive), as two arrays of equal
+    length: hour-start timestamps and values (NaN where no reading was stored).
+    """
+    start = start // 3600 * 3600
+    timestamps = array('d')
+    values = array('d')
+    hour_start = start
+    while hour_start < end:
+        year, first = _history_slot(hour_start)
+        next_year = datetime(year + 1, 1, 1, tzinfo=timezone.utc).timestamp()
+        count = int(math.ceil((min(end, next_year) - hour_start) / 3600))
+        timestamps.extend(hour_start + 3600 * hour for hour in range(count))
+        values.extend(_read_history_slots(_history_path(sensor_id, pollutant, year), first, count).tolist())
+        hour_start += 3600 * count
+    return timestamps, values
+
+def rolling_mean(values, window, min_coverage=HISTORY_MIN_COVERAGE):
+    """
+    Trailing mean over the last `window` hourly values at every position of the
+    series, computed in one pass with running sums. NaN gaps are skipped; a
+    position gets NaN when fewer than min_coverage of its window has data.
+    """
+    means = array('d', [math.nan] * len(values))
+    needed = max(1, math.ceil(window * min_coverage))
+    total = 0.0
+    count = 0
+    for i, value in enumerate(values):
+        if value == value:
+            total += value
+            count += 1
+        if i >= window:
+            old = values[i - window]
+            if old == old:
+                total -= old
+                count -= 1
+        if count >= needed:
+            means[i] = total / count
+    return means
+
+def history_mean(sensor_id, pollutant, hours, now=None):
+    """
+    Mean of the last `hours` hourly values up to `now` (epoch seconds), e.g. the
+    24 h PM mean or the 8 h ozone mean. Returns None if data capture is too low.
+    """
+    now = time.time() if now is None else now
+    end = now // 3600 * 3600
+    _, values = query_history(sensor_id, pollutant, end - hours * 3600, end)
+    mean = rolling_mean(values, hours)[-1] if values else math.nan
+    return None if math.isnan(mean) else mean
+
+_record_lock = threading.Lock()
+
+def _open_recording(path, mode):
+    return gzip.open(path, mode + "t", encoding="utf-8") if path.endswith(".gz") else open(path, mode, encoding="utf-8")
+
+def record_response(sensor_id, body):
+    """
+    Appends a raw measurement response body to AIRLY_RECORD_PATH as one JSON line.
+    """
+    if "\n" in body:
+        body = json.dumps(json.loads(body))
+    line = f'{{"installationId": {json.dumps(sensor_id)}, "fetchedAt": {time.time()}, "response": {body}}}'
+    with _record_lock:
+        with _open_recording(AIRLY_RECORD_PATH, "a") as f:
+            f.write(line + "\n")
+
+# --- Airly Response Parser ---
+# Responses are walked key by key instead of being loaded whole: "current" is
+# decoded, and "history" entries are decoded one at a time (and can be streamed
+# into the history store). Other arrays, such as "forecast", are stepped over
+# element by element unless a callback asks for them. Only the configured
+# pollutants are kept, in a fixed-layout record.
+POLLUTANT_FIELDS = tuple(os.getenv('POLLUTANT_FIELDS', "PM2.5,PM10,NO2,O3,SO2").split(","))
+
+_json_decoder = json.JSONDecoder()
+_JSON_WHITESPACE = re.compile(r"[ \t\n\r]*")
+_column_maps = {}
+
+def _column_map(pollutants):
+    """
+    Maps every Airly value name (including aliases) of `pollutants` to its column.
+    """
+    columns = _column_maps.get(pollutants)
+    if columns is None:
+        columns = {p: i for i, p in enumerate(pollutants)}
+        columns.update({alias: columns[name] for alias, name in AIRLY_NAME_ALIASES.items() if name in columns})
+        _column_maps[pollutants] = columns
+    return columns
+
+class AirlyReading:
+    """
+    One installation's measurement: the current value of each pollutant in
+    `pollutants` (NaN if missing) and, row by row, the same pollutants for
+    every hour of the response's history (and, if kept, forecast) array,
+    with each row's hour-start time.
+    """
+    __slots__ = ("installation_id", "pollutants", "from_time", "till_time", "values",
+                 "history", "history_times", "forecast", "forecast_times")
+
+    def __init__(self, installation_id, pollutants=POLLUTANT_FIELDS):
+        self.installation_id = installation_id
+        self.pollutants = pollutants
+        self.from_time = None
+        self.till_time = None
+        self.values = array('d', [math.nan] * len(pollutants))
+        self.history = array('d')
+        self.history_times = array('d')
+        self.forecast = array('d')
+        self.forecast_times = array('d')
+
+    @classmethod
+    def from_response(cls, installation_id, data, pollutants=POLLUTANT_FIELDS):
+        """
+        Builds a reading from an already decoded response, e.g. a recorded one.
+        """
+        reading = cls(installation_id, pollutants)
+        for entry in data.get("history") or []:
+            reading.add_history(entry)
+        for entry in data.get("forecast") or []:
+            reading.add_forecast(entry)
+        reading.set_current(data.get("current") or {})
+        return reading
+
+    def _row(self, entry):
+        row = array('d', [math.nan] * len(self.pollutants))
+        columns = _column_map(self.pollutants)
+        for item in entry.get("values", ()):
+            col = columns.get(item["name"])
+            if col is not None and item.get("value") is not None:
+                row[col] = item["value"]
+        return row
+
+    def set_current(self, entry):
+        self.values = self._row(entry)
+        self.from_time = parse_airly_time(entry["fromDateTime"]) if entry.get("fromDateTime") else None
+        self.till_time = parse_airly_time(entry["tillDateTime"]) if entry.get("tillDateTime") else None
+
+    def add_history(self, entry):
+        if entry.get("fromDateTime"):
+            self.history.extend(self._row(entry))
+            self.history_times.append(parse_airly_time(entry["fromDateTime"]))
+
+    def add_forecast(self, entry):
+        if entry.get("fromDateTime"):
+            self.forecast.extend(self._row(entry))
+            self.forecast_times.append(parse_airly_time(entry["fromDateTime"]))
+
+    def observations(self, pollutant):
+        """
+        Yields (hour_start, value) for every known hourly value of a pollutant,
+        oldest first: the history rows followed by the current reading.
+        """
+        col = _column_map(self.pollutants)[pollutant]
+        width = len(self.pollutants)
+        for row, start in enumerate(self.history_times):
+            value = self.history[row * width + col]
+            if value == value:
+                yield start, value
+        if self.from_time is not None and self.values[col] == self.values[col]:
+            yield self.from_time, self.values[col]
+
+    def forecast_dict(self):
+        """
+        Returns {pollutant: {hour_start: value}} for the forecast rows.
+        """
+        width = len(self.pollutants)
+        forecast = {}
+        for row, start in enumerate(self.forecast_times):
+            for col, pollutant in enumerate(self.pollutants):
+                value = self.forecast[row * width + col]
+                if value == value:
+                    forecast.setdefault(pollutant, {})[start] = value
+        return forecast
+
+    def get(self, pollutant):
+        value = self.values[_column_map(self.pollutants)[pollutant]]
+        return None if value != value else value
+
+    def as_dict(self):
+        return {p: v for p, v in zip(self.pollutants, self.values) if v == v}
+
+    def mean(self, pollutant, hours):
+        """
+        Mean of a pollutant over the last `hours` hourly values of the response
+        (history plus current). Returns None if data capture is too low.
+        """
+        col = _column_map(self.pollutants)[pollutant]
+        series = self.history[col::len(self.pollutants)]
+        series.append(self.values[col])
+        mean = rolling_mean(series[-hours:], hours)[-1]
+        return None if math.isnan(mean) else mean
+
+def _skip_json_value(text, pos):
+    """
+    Returns the position just past the JSON value at `pos`. Arrays are decoded
+    and dropped one element at a time, so skipping a long array never holds
+    more than one of its elements in memory.
+    """
+    if text[pos] == "[":
+        return _scan_json_array(text, pos, lambda element: None)
+    return _json_decoder.raw_decode(text, pos)[1]
+
+def _scan_json_array(text, pos, callback):
+    """
+    Decodes the JSON array at `pos` one element at a time, passing each to
+    callback. Returns the position just past the array.
+    """
+    if text[pos] != "[":
+        return _json_decoder.raw_decode(text, pos)[1]
+    pos = _JSON_WHITESPACE.match(text, pos + 1).end()
+    while text[pos] != "]":
+        element, pos = _json_decoder.raw_decode(text, pos)
+        callback(element)
+        pos = _JSON_WHITESPACE.match(text, pos).end()
+        if text[pos] == ",":
+            pos = _JSON_WHITESPACE.match(text, pos + 1).end()
+    return pos + 1
+
+def scan_airly_response(installation_id, body, pollutants=POLLUTANT_FIELDS, on_entry=None, keep_forecast=False):
+    """
+    Parses an Airly measurement response body in a single pass and returns an
+    AirlyReading, including the forecast rows if keep_forecast is set. If
+    on_entry is given it is called as on_entry(section, entry) for every
+    "current", "history" and "forecast" entry, so they can be stored without
+    building the whole document.
+    """
+    reading = AirlyReading(installation_id, pollutants)
+    pos = _JSON_WHITESPACE.match(body, 0).end()
+    if body[pos] != "{":
+        raise ValueError("Airly response is not a JSON object")
+    pos = _JSON_WHITESPACE.match(body, pos + 1).end()
+    while body[pos] != "}":
+        key, pos = _json_decoder.raw_decode(body, pos)
+        pos = _JSON_WHITESPACE.match(body, pos).end()
+        if body[pos] != ":":
+            raise ValueError(f"Malformed Airly response at position {pos}")
+        pos = _JSON_WHITESPACE.match(body, pos + 1).end()
+
+        if key == "current":
+            entry, pos = _json_decoder.raw_decode(body, pos)
+            if entry:
+                reading.set_current(entry)
+                if on_entry:
+                    on_entry(key, entry)
+        elif key == "history":
+            def take_history(entry):
+                reading.add_history(entry)
+                if on_entry:
+                    on_entry("history", entry)
+            pos = _scan_json_array(body, pos, take_history)
+        elif key == "forecast" and (on_entry or keep_forecast):
+            def take_forecast(entry):
+                if keep_forecast:
+                    reading.add_forecast(entry)
+                if on_entry:
+                    on_entry("forecast", entry)
+            pos = _scan_json_array(body, pos, take_forecast)
+        else:
+            pos = _skip_json_value(body, pos)
+
+        pos = _JSON_WHITESPACE.match(body, pos).end()
+        if body[pos] == ",":
+            pos = _JSON_WHITESPACE.match(body, pos + 1).end()
+    return reading
+
+def parse_air_quality(sensor, reading, now=None, use_history=True):
+    """
+    Turns an AirlyReading into the result used by the tweet logic.
+    Pollutants are averaged over their DAQI period from the history store
+    (as of `now`, epoch seconds) or, failing that, from the response itself.
+    """
+    sensor_id = sensor["id"]
+
+    # Extract the DAQI pollutants for tweet logic
+    pollutants_tweet = {p: v for p, v in reading.as_dict().items() if p in DAQI_BREAKPOINTS}
+
+    # Use the official DAQI averaging period where enough history exists
+    for pollutant in pollutants_tweet:
+        hours = DAQI_AVERAGING_HOURS[pollutant]
+        if hours > 1:
+            mean = history_mean(sensor_id, pollutant, hours, now) if use_history and HISTORY_DIR else None
+            if mean is None:
+                mean = reading.mean(pollutant, hours)
+            if mean is not None:
+                pollutants_tweet[pollutant] = mean
+
+    # Return  pollutants for tweet
+    return {
+        "sensor_id": sensor_id,
+        "sensor_name": sensor["name"],
+        "pollutants_tweet": pollutants_tweet,
+        "forecast": reading.forecast_dict(),
+        "observed": {p: dict(reading.observations(p)) for p in DAQI_BREAKPOINTS if p in reading.pollutants},
+        "till_time": reading.till_time,
+    }
+
+def get_air_quality(sensor):
+    """
+    Fetches air quality data from the Airly API for a single sensor.
+    Returns a dictionary containing specific pollutants for tweet logic.
+    """
+    sensor_id = sensor["id"]
+    try:
+        body = fetch_airly_measurements(sensor_id)
+        if AIRLY_RECORD_PATH:
+            try:
+                record_response(sensor_id, body)
+            except (OSError, ValueError) as e:
+                logging.warning(f"Could not record response for sensor {sensor_id}: {e}")
+
+        # History entries go straight into a pending store update while parsing
+        updates = {}
+        on_entry = None
+        if HISTORY_DIR:
+            def on_entry(section, entry):
+                if section != "forecast":
+                    add_history_entry(sensor_id, entry, updates)
+        with timed("json_parse"):
+            reading = scan_airly_response(sensor_id, body, on_entry=on_entry, keep_forecast=FORECAST_ENABLED)
+        if updates:
+            try:
+                with timed("history_write"):
+                    write_history_updates(updates)
+            except OSError as e:
+                logging.warning(f"Could not record history for sensor {sensor_id}: {e}")
+        if FORECAST_ENABLED:
+            with timed("forecast_update"):
+                update_forecast_models(sensor_id, reading)
+        update_quality_windows(sensor_id, reading)
+        with timed("extract"):
+            return parse_air_quality(sensor, reading)
+    except (requests.RequestException, ValueError, KeyError, IndexError) as e:
+        increment("sensor_errors")
         logging.error(f"Error fetching data for sensor {sensor_id}: {e}")
         return None
 
 
 
-def get_air_quality_for_all_sensors(sensors):
+def get_air_quality_for_all_sensors(sensors, max_workers=None, deadline=None):
     """
     Aggregates air quality data from all sensors.
-    Returns a list of dictionaries, each containing sensor name, and  pollutants.
+    Sensors are fetched concurrently over the shared Airly session, with at most
+    max_workers requests in flight. Sensors that have not answered once the
+    batch deadline (in seconds) has passed are logged and left out, so partial
+    results can still be tweeted.
+    Returns a list of dictionaries, each containing sensor name, and  pollutants,
+    in the same order as the sensors argument.
     """
+    if not sensors:
+        return []
+    max_workers = max_workers or AIRLY_MAX_WORKERS
+    deadline = AIRLY_BATCH_DEADLINE if deadline is None else deadline
+
+    batch_start = time.perf_counter()
+    executor = ThreadPoolExecutor(max_workers=min(max_workers, len(sensors)))
+    try:
+        futures = [executor.submit(get_air_quality, sensor) for sensor in sensors]
+        done, not_done = wait(futures, timeout=deadline)
+        for sensor, future in zip(sensors, futures):
+            if future in not_done:
+                future.cancel()
+                logging.error(f"Batch deadline of {deadline}s reached before sensor {sensor['id']} responded.")
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+    observe("fetch_batch", time.perf_counter() - batch_start)
+    if FORECAST_ENABLED:
+        save_forecast_models()
+    increment("sensors_requested", len(sensors))
+    increment("sensors_missed_deadline", len(not_done))
+
     all_results = []
-    for sensor in sensors:
-        result = get_air_quality(sensor)
-        if result:
-            all_results.append(result)
+    for future in futures:
+        if future in done and not future.cancelled():
+            result = future.result()
+            if result:
+                all_results.append(result)
     return all_results
 
+# --- Installation Discovery ---
+# Localities with a location pick their sensors from Airly's installation list
+# instead of a hand-maintained id list. Installations are cached on disk and
+# indexed in a lat/lng grid, so nearest-sensor lookups only examine the few
+# cells around a point even with tens of thousands of installations.
+INSTALLATIONS_CACHE_PATH = os.getenv('INSTALLATIONS_CACHE_PATH', "airly_installations.json")
+DISCOVERY_REFRESH = int(os.getenv('DISCOVERY_REFRESH', "86400"))
+DISCOVERY_GRID_DEGREES = 0.05
+DISCOVERY_MIN_DISTANCE_KM = 0.1  # floor for inverse-distance weights
+EARTH_RADIUS_KM = 6371.0
+
+_installation_index = {"loaded_at": None, "grid": {}}
+
+def haversine_km(lat1, lng1, lat2, lng2):
+    """
+    Great-circle distance in kilometres between two lat/lng points.
+    """
+    dlat = math.radians(lat2 - lat1)
+    dlng = math.radians(lng2 - lng1)
+    a = math.sin(dlat / 2) ** 2 + math.cos(math.radians(lat1)) * math.cos(math.radians(lat2)) * math.sin(dlng / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(math.sqrt(a))
+
+def _grid_cell(lat, lng):
+    return int(math.floor(lat / DISCOVERY_GRID_DEGREES)), int(math.floor(lng / DISCOVERY_GRID_DEGREES))
+
+def build_installation_index(installations):
+    """
+    Buckets installations into a grid of DISCOVERY_GRID_DEGREES cells.
+    Returns a dict of (row, col) -> list of (lat, lng, installation).
+    """
+    grid = {}
+    for installation in installations:
+        location = installation.get("location") or {}
+        lat, lng = location.get("latitude"), location.get("longitude")
+        if lat is None or lng is None:
+            continue
+        grid.setdefault(_grid_cell(lat, lng), []).append((lat, lng, installation))
+    return grid
+
+def nearest_installations(grid, lat, lng, radius_km, limit=None):
+    """
+    Returns (distance_km, installation) pairs within radius_km of a point,
+    nearest first, scanning only the grid cells the radius can reach.
+    """
+    lat_span = radius_km / 111.0
+    lng_span = radius_km / (111.0 * max(0.01, math.cos(math.radians(lat))))
+    row_min, col_min = _grid_cell(lat - lat_span, lng - lng_span)
+    row_max, col_max = _grid_cell(lat + lat_span, lng + lng_span)
+    matches = []
+    for row in range(row_min, row_max + 1):
+        for col in range(col_min, col_max + 1):
+            for item_lat, item_lng, installation in grid.get((row, col), ()):
+                distance = haversine_km(lat, lng, item_lat, item_lng)
+                if distance <= radius_km:
+                    matches.append((distance, installation))
+    matches.sort(key=lambda match: match[0])
+    return matches[:limit] if limit else matches
+
+def _read_installations_cache():
+    try:
+        with open(INSTALLATIONS_CACHE_PATH, encoding="utf-8") as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {"queries": {}, "installations": {}}
+
+def refresh_installations(lat, lng, radius_km):
+    """
+    Makes sure the installation cache holds a recent (< DISCOVERY_REFRESH)
+    listing of every installation within radius_km of a point, downloading it
+    from /v2/installations/nearest if not. Installations no longer listed by
+    Airly in that area are dropped, so decommissioned sensors stop being used.
+    If the download fails the cached listing is used as it is.
+    Returns the grid index over all cached installations.
+    """
+    cache = _read_installations_cache()
+    query = f"{lat:.4f},{lng:.4f},{radius_km}"
+    if time.time() - cache["queries"].get(query, 0) > DISCOVERY_REFRESH:
+        try:
+            url = f"{AIRLY_API_URL}/v2/installations/nearest"
+            params = {"lat": lat, "lng": lng, "maxDistanceKM": radius_km, "maxResults": -1}
+            response = get_airly_session().get(url, params=params, timeout=AIRLY_TIMEOUT)
+            response.raise_for_status()
+            discovered = response.json()
+            installations = dict(cache["installations"])
+            for installation_id, installation in list(installations.items()):
+                location = installation.get("location") or {}
+                if haversine_km(lat, lng, location.get("latitude", 90), location.get("longitude", 0)) <= radius_km:
+                    del installations[installation_id]
+            for installation in discovered:
+                installations[str(installation["id"])] = installation
+            cache["installations"] = installations
+            cache["queries"][query] = time.time()
+            tmp_path = INSTALLATIONS_CACHE_PATH + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(cache, f)
+            os.replace(tmp_path, INSTALLATIONS_CACHE_PATH)
+            logging.info(f"Discovered {len(discovered)} Airly installations near {lat}, {lng}.")
+        except (requests.RequestException, OSError, ValueError, KeyError, TypeError) as e:
+            logging.error(f"Error discovering installations near {lat}, {lng}, using the cached list: {e}")
+        _installation_index["loaded_at"] = None
+    return cached_installation_index(cache)
+
+def cached_installation_index(cache=None):
+    """
+    Returns the grid index over the installations in INSTALLATIONS_CACHE_PATH
+    without contacting Airly, rebuilding it only when the file has changed.
+    """
+    mtime = os.path.getmtime(INSTALLATIONS_CACHE_PATH) if os.path.exists(INSTALLATIONS_CACHE_PATH) else 0
+    if _installation_index["loaded_at"] != mtime:
+        cache = cache or _read_installations_cache()
+        _installation_index["grid"] = build_installation_index(cache["installations"].values())
+        _installation_index["loaded_at"] = mtime
+    return _installation_index["grid"]
+
+def _installation_name(installation):
+    address = installation.get("address") or {}
+    return (address.get("displayAddress2") or address.get("street")
+            or f"Installation {installation['id']}")
+
+def resolve_locality_sensors(locality, offline=False):
+    """
+    Sets a located locality's sensors to its nearest active installations,
+    each with its distance_km from the locality's location. Falls back to the
+    configured sensors if discovery fails or finds nothing. With offline set,
+    only the installations already cached on disk are considered.
+    """
+    lat, lng = locality["location"]["lat"], locality["location"]["lng"]
+    if offline:
+        grid = cached_installation_index()
+    else:
+        grid = refresh_installations(lat, lng, locality["radius_km"])
+    nearest = nearest_installations(grid, lat, lng, locality["radius_km"], locality["max_sensors"])
+    if nearest:
+        locality["sensors"] = [
+            {"id": installation["id"], "name": _installation_name(installation), "distance_km": distance}
+            for distance, installation in nearest
+        ]
+    else:
+        locality["sensors"] = locality["configured_sensors"]
+    return locality["sensors"]
+
+def get_air_quality_for_localities(localities):
+    """
+    Fetches every installation used by the given localities in one concurrent
+    batch, fetching sensors shared between localities only once.
+    Returns a dict of sensor id -> result.
+    """
+    unique_sensors = {}
+    for locality in localities:
+        for sensor in locality["sensors"]:
+            unique_sensors.setdefault(sensor["id"], sensor)
+    results = get_air_quality_for_all_sensors(list(unique_sensors.values()))
+    return {result["sensor_id"]: result for result in results}
+
+def locality_results(locality, results_by_id):
+    """
+    Picks a locality's sensors out of a shared batch, using the sensor names
+    (and discovered distances) from that locality's own configuration.
+    """
+    return [
+        dict(results_by_id[sensor["id"]], sensor_name=sensor["name"], distance_km=sensor.get("distance_km"))
+        for sensor in locality["sensors"] if sensor["id"] in results_by_id
+    ]
+
+UNAVAILABLE_TWEET = "Air quality data is unavailable at this time. Please check back later."
+
+# --- Daily Air Quality Index (DAQI) ---
+POLLUTION_LEVELS = ("low", "mediocre", "high", "emergency")
+
+# Lower bound (µg/m³) of DAQI indexes 2-10 per pollutant. An index is found by
+# bisecting these with the rounded concentration, so classifying a value is
+# O(log n) and whole series can be classified without per-band branching.
+DAQI_BREAKPOINTS = {
+    "PM2.5": (12, 24, 36, 42, 48, 54, 59, 65, 71),
+    "PM10":  (17, 34, 51, 59, 67, 76, 84, 92, 101),
+    "NO2":   (68, 135, 201, 268, 335, 401, 468, 535, 601),
+    "O3":    (34, 67, 101, 121, 141, 161, 188, 214, 241),
+    "SO2":   (89, 178, 266, 355, 444, 533, 711, 888, 1065),
+}
+
+# Averaging period (hours) each DAQI band is defined on. SO2 is officially a
+# 15-minute mean; Airly's hourly value is the closest available.
+DAQI_AVERAGING_HOURS = {"PM2.5": 24, "PM10": 24, "NO2": 1, "O3": 8, "SO2": 1}
+
+# DAQI index -> TEMPLATES tier: 1-3 Low, 4-6 Moderate, 7-9 High, 10 Very High.
+DAQI_LEVELS = (None, "low", "low", "low", "mediocre", "mediocre", "mediocre", "high", "high", "high", "emergency")
+
+def daqi_index(pollutant, value):
+    """
+    Returns the DAQI index (1-10) for a pollutant concentration averaged over
+    its DAQI period, or None for pollutants without DAQI bands.
+    """
+    bounds = DAQI_BREAKPOINTS.get(pollutant)
+    if bounds is None or value is None or value != value:
+        return None
+    return bisect_right(bounds, round(value)) + 1
+
+def daqi_indices(pollutant, values):
+    """
+    Classifies a whole series of averaged concentrations at once.
+    Returns an array of DAQI indexes, with 0 where a value is missing (NaN).
+    """
+    bounds = DAQI_BREAKPOINTS[pollutant]
+    return array('b', (bisect_right(bounds, round(v)) + 1 if v == v else 0 for v in values))
+
+def daqi_series(sensor_id, pollutant, start, end):
+    """
+    Back-fills DAQI indexes from the history store: the hourly series between
+    start and end is averaged over the pollutant's DAQI period and classified.
+    Returns (timestamps, indexes).
+    """
+    hours = DAQI_AVERAGING_HOURS[pollutant]
+    timestamps, values = query_history(sensor_id, pollutant, start - (hours - 1) * 3600, end)
+    averaged = rolling_mean(values, hours)[hours - 1:] if hours > 1 else values
+    return timestamps[hours - 1:], daqi_indices(pollutant, averaged)
+
+def overall_daqi(pollutants):
+    """
+    Overall DAQI index for a set of readings: the highest pollutant index,
+    or None if no pollutant has a DAQI band.
+    """
+    return max((i for i in (daqi_index(p, v) for p, v in pollutants.items()) if i), default=None)
+
 def determine_pollution_level(pollutants):
     """
-    Determines the pollution level based on DEFRA thresholds.
+    Determines the pollution level from the overall DAQI index.
     Returns "low", "mediocre", "high", or "emergency".
     """
-    DEFRA_LIMITS = {
-        "PM2.5": {"moderate": 12, "high": 24, "emergency": 36},
-        "PM10":  {"moderate": 17, "high": 34, "emergency": 50},
-        "NO2":   {"moderate": 67, "high": 134, "emergency": 200},
-        "NO":    {"moderate": 25, "high": 50, "emergency": 75}
-    }
-    level = "low"
-    for pollutant, value in pollutants.items():
-        limits = DEFRA_LIMITS.get(pollutant)
-        if limits:
-            if value > limits["emergency"]:
-                return "emergency"
-            elif value > limits["high"]:
-                level = "high"
-            elif value > limits["moderate"] and level not in ("high", "emergency"):
-                level = "mediocre"
-    return level
-
-def prepare_sensor_tweet():
+    return DAQI_LEVELS[overall_daqi(pollutants) or 1]
+
+def _column_median(column):
+    column = sorted(column)
+    mid = len(column) // 2
+    return column[mid] if len(column) % 2 else (column[mid - 1] + column[mid]) / 2
+
+# --- Data Quality ---
+# Readings are screened before aggregation so one faulty low-cost sensor
+# cannot set the town's level or trigger the outlier note. A sensor is
+# dropped if its measurement is stale; a single pollutant is dropped if it
+# is outside physical bounds, has flat-lined, or disagrees with the
+# locality's other sensors (robust z-score against their median/MAD) while
+# also being unusual for the sensor itself (against its own rolling
+# median/MAD). Each sensor keeps the last QC_WINDOW_HOURS hourly values per
+# pollutant in memory, in a fixed-size array ring buffer. Rejections are
+# appended to QC_AUDIT_PATH.
+QC_MAX_AGE = int(os.getenv('QC_MAX_AGE', "10800"))               # seconds since tillDateTime
+QC_FLATLINE_HOURS = int(os.getenv('QC_FLATLINE_HOURS', "6"))     # identical hourly values in a row
+QC_WINDOW_HOURS = int(os.getenv('QC_WINDOW_HOURS', "48"))
+QC_MAD_THRESHOLD = float(os.getenv('QC_MAD_THRESHOLD', "3.5"))   # robust z-score
+QC_MIN_NEIGHBOURS = 3
+QC_MAD_FLOOR = 2.0   # µg/m³, stops near-identical sensors making every difference an outlier
+QC_AUDIT_PATH = os.getenv('QC_AUDIT_PATH', "quality_rejections.jsonl")
+
+QC_BOUNDS = {   # plausible hourly range in µg/m³
+    "PM2.5": (0.0, 1000.0),
+    "PM10": (0.0, 2000.0),
+    "NO2": (0.0, 2000.0),
+    "O3": (0.0, 1000.0),
+    "SO2": (0.0, 2000.0),
+}
+
+_quality_lock = threading.Lock()
+_quality_windows = {}
+
+class _QualityWindow:
     """
-    Prepares a tweet based on sensor data.
-    Determines the overall pollution level and randomly selects a tweet
-    from the corresponding pool. If an outlier sensor exists, a note is appended.
+    Ring buffer of a sensor's last QC_WINDOW_HOURS hourly values for one
+    pollutant, with the hour-start time of the newest.
+    """
+    __slots__ = ("ts", "values", "count", "next")
+
+    def __init__(self, size=None):
+        self.ts = None
+        self.values = array('d', [math.nan] * (size or QC_WINDOW_HOURS))
+        self.count = 0
+        self.next = 0
+
+    def append(self, start, value):
+        self.values[self.next] = value
+        self.next = (self.next + 1) % len(self.values)
+        self.count = min(self.count + 1, len(self.values))
+        self.ts = start
+
+    def latest(self):
+        return self.values[self.next - 1] if self.count else None
+
+    def recent(self, hours=None):
+        """
+        Returns the last `hours` values (all held values by default), oldest first.
+        """
+        hours = self.count if hours is None else min(hours, self.count)
+        return [self.values[(self.next - hours + i) % len(self.values)] for i in range(hours)]
+
+def update_quality_windows(sensor_id, reading):
+    """
+    Appends a reading's hourly values newer than the last one seen to the
+    sensor's rolling windows.
+    """
+    with _quality_lock:
+        for pollutant in QC_BOUNDS:
+            if pollutant not in reading.pollutants:
+                continue
+            window = _quality_windows.get((sensor_id, pollutant))
+            if window is None:
+                window = _quality_windows[(sensor_id, pollutant)] = _QualityWindow()
+            for start, value in reading.observations(pollutant):
+                if window.ts is None or start > window.ts:
+                    window.append(start, value)
+
+def _median_mad(values):
+    median = _column_median(values)
+    return median, _column_median([abs(v - median) for v in values])
+
+def _robust_score(value, median, mad):
+    return 0.6745 * abs(value - median) / max(mad, QC_MAD_FLOOR)
+
+def _is_flat(window):
+    if window.count < QC_FLATLINE_HOURS:
+        return False
+    recent = window.recent(QC_FLATLINE_HOURS)
+    return max(recent) - min(recent) < 1e-9
+
+def _record_rejections(rejections, path):
+    if not path or not rejections:
+        return
+    try:
+        with open(path, "a", encoding="utf-8") as f:
+            for rejection in rejections:
+                f.write(json.dumps(rejection, ensure_ascii=False) + "\n")
+    except OSError as e:
+        logging.warning(f"Could not write data-quality audit log: {e}")
+
+def screen_readings(results, now=None, audit_path=None):
+    """
+    Applies the data-quality checks to one locality's sensor results and
+    returns copies with rejected pollutants removed. Sensors that are stale
+    or left with no pollutants are dropped. `now` is epoch seconds.
+    Rejections go to audit_path (QC_AUDIT_PATH by default, "" for none).
+    """
+    now = time.time() if now is None else now
+    rejections = []
+
+    def reject(result, pollutant, value, reason, score=None):
+        rejections.append({"time": datetime.fromtimestamp(now, timezone.utc).isoformat(),
+                           "sensor_id": result["sensor_id"], "sensor_name": result["sensor_name"],
+                           "pollutant": pollutant, "value": value, "reason": reason, "score": score})
+
+    fresh = []
+    for result in results:
+        till = result.get("till_time")
+        if till is not None and now - till > QC_MAX_AGE:
+            reject(result, None, None, "stale", round((now - till) / 3600, 1))
+        else:
+            fresh.append(result)
+
+    keep = [dict(r["pollutants_tweet"]) for r in fresh]
+    with _quality_lock:
+        for pollutant, (low, high) in QC_BOUNDS.items():
+            rows = []
+            for row, readings in enumerate(keep):
+                if pollutant not in readings:
+                    continue
+                value = readings[pollutant]
+                window = _quality_windows.get((fresh[row]["sensor_id"], pollutant))
+                latest = window.latest() if window and window.count else value
+                if not (low <= value <= high and low <= latest <= high):
+                    reason = "out_of_bounds"
+                    value = value if not low <= value <= high else latest
+                elif window and _is_flat(window):
+                    reason = "flatline"
+                else:
+                    rows.append(row)
+                    continue
+                reject(fresh[row], pollutant, value, reason)
+                del readings[pollutant]
+
+            if len(rows) < QC_MIN_NEIGHBOURS:
+                continue
+            # One median/MAD per column; every row is scored against it.
+            column = array('d', (keep[row][pollutant] for row in rows))
+            median, mad = _median_mad(column)
+            for row, value in zip(rows, column):
+                neighbour_score = _robust_score(value, median, mad)
+                if neighbour_score <= QC_MAD_THRESHOLD:
+                    continue
+                window = _quality_windows.get((fresh[row]["sensor_id"], pollutant))
+                if window and window.count >= QC_FLATLINE_HOURS \
+                        and _robust_score(value, *_median_mad(window.recent())) <= QC_MAD_THRESHOLD:
+                    continue   # normal for this sensor, e.g. a roadside site
+                reject(fresh[row], pollutant, value, "neighbour_disagreement", round(neighbour_score, 2))
+                del keep[row][pollutant]
+
+    for rejection in rejections:
+        logging.info(f"Rejected {rejection['pollutant'] or 'all readings'} from {rejection['sensor_name']}: "
+                     f"{rejection['reason']}.")
+    increment("readings_rejected", len(rejections))
+    _record_rejections(rejections, QC_AUDIT_PATH if audit_path is None else audit_path)
+    return [dict(r, pollutants_tweet=readings) for r, readings in zip(fresh, keep) if readings]
+
+def aggregate_readings(results):
+    """
+    Aggregates a batch of sensor results one pollutant column at a time and
+    derives everything the tweet logic needs from the columns:
+        - per-pollutant network mean, median and max; when every result has a
+          distance_km the mean is inverse-distance weighted
+        - per-sensor exceedance: the highest ratio of value to the start of the
+          pollutant's Moderate band, so different units compare on one scale
+        - per-sensor DAQI indexes, the network index (from the means) and the worst sensor
+    This is a plain-Python pass over the readings, not a vectorised one.
+    Returns None if no sensor reported a pollutant with DAQI bands.
     """
-    time_of_day = get_time_of_day()
-    results = get_air_quality_for_all_sensors(SENSORS)
-    if not results:
-        return "Air quality data is unavailable at this time. Please check back later."
-
-    # Use pollutants_tweet for tweet logic
-    avg_data_tweet = {}
-    max_data_tweet = {"pollutants": {}} #initialise with empty dict to prevent errors.
-    max_sensor_name = ""
-    for sensor_data in results:
-        for pollutant, value in sensor_data["pollutants_tweet"].items():
-            avg_data_tweet.setdefault(pollutant, []).append(value)
-        if sensor_data['pollutants_tweet'] and max(sensor_data['pollutants_tweet'].values(), default=0) > max(max_data_tweet["pollutants"].values(), default=0):
-            max_data_tweet["pollutants"] = sensor_data["pollutants_tweet"]
-            max_sensor_name = sensor_data["sensor_name"]
-
-    if avg_data_tweet:
-        avg_data = {k: sum(v) / len(v) for k, v in avg_data_tweet.items()}
+    pollutants = [p for p in DAQI_BREAKPOINTS if any(p in r["pollutants_tweet"] for r in results)]
+    if not pollutants:
+        return None
+
+    if all(r.get("distance_km") is not None for r in results):
+        weights = [1 / max(r["distance_km"], DISCOVERY_MIN_DISTANCE_KM) for r in results]
     else:
-        return "Air quality data is unavailable at this time. Please check back later."
+        weights = [1.0] * len(results)
+
+    mean = {}
+    median = {}
+    maximum = {}
+    exceedance = [0.0] * len(results)
+    sensor_daqi = [1] * len(results)
+    for pollutant in pollutants:
+        moderate = DAQI_BREAKPOINTS[pollutant][2]
+        column = []
+        weighted_sum = 0.0
+        weight_sum = 0.0
+        for row, sensor_data in enumerate(results):
+            value = sensor_data["pollutants_tweet"].get(pollutant)
+            if value is None or value != value:
+                continue
+            column.append(value)
+            weighted_sum += value * weights[row]
+            weight_sum += weights[row]
+            exceedance[row] = max(exceedance[row], value / moderate)
+            sensor_daqi[row] = max(sensor_daqi[row], daqi_index(pollutant, value))
+        mean[pollutant] = weighted_sum / weight_sum
+        median[pollutant] = _column_median(column)
+        maximum[pollutant] = max(column)
+
+    worst = max(range(len(results)), key=lambda row: (sensor_daqi[row], exceedance[row]))
+    network_daqi = overall_daqi(mean)
+    return {
+        "pollutants": pollutants,
+        "mean": mean,
+        "median": median,
+        "max": maximum,
+        "exceedance": exceedance,
+        "sensor_daqi": sensor_daqi,
+        "sensor_levels": [DAQI_LEVELS[i] for i in sensor_daqi],
+        "daqi": network_daqi,
+        "level": DAQI_LEVELS[network_daqi],
+        "worst_sensor": results[worst]["sensor_name"],
+        "worst_level": DAQI_LEVELS[sensor_daqi[worst]],
+    }
+
+# --- Short-Horizon Forecast ---
+# Each installation and pollutant has a damped-trend exponential smoothing
+# (Holt) model that is updated in O(1) per new hourly reading and kept in
+# FORECAST_STATE_PATH. Its predictions are blended with Airly's own forecast
+# to find the worst level expected FORECAST_MIN_HOURS-FORECAST_MAX_HOURS ahead.
+# Predicted hours are rolled together with observed ones over each
+# pollutant's DAQI averaging period before banding, like current readings.
+FORECAST_STATE_PATH = os.getenv('FORECAST_STATE_PATH', "forecast_state.json")
+FORECAST_ENABLED = bool(FORECAST_STATE_PATH)
+FORECAST_MIN_HOURS = int(os.getenv('FORECAST_MIN_HOURS', "3"))
+FORECAST_MAX_HOURS = int(os.getenv('FORECAST_MAX_HOURS', "12"))
+FORECAST_AIRLY_WEIGHT = float(os.getenv('FORECAST_AIRLY_WEIGHT', "0.6"))
+FORECAST_ALPHA = 0.5   # level smoothing
+FORECAST_BETA = 0.1    # trend smoothing
+FORECAST_DAMPING = 0.9  # per-hour trend damping, keeps long horizons sane
+
+LEVEL_NAMES = {"low": "low", "mediocre": "moderate", "high": "high", "emergency": "very high"}
+
+_forecast_lock = threading.Lock()
+_forecast_models = {"loaded": False, "dirty": False, "models": {}}
 
-    level_avg = determine_pollution_level(avg_data)
-    level_max = determine_pollution_level(max_data_tweet["pollutants"])
+def _forecast_state():
+    if not _forecast_models["loaded"]:
+        try:
+            with open(FORECAST_STATE_PATH, encoding="utf-8") as f:
+                _forecast_models["models"] = json.load(f)
+        except (FileNotFoundError, ValueError):
+            _forecast_models["models"] = {}
+        _forecast_models["loaded"] = True
+    return _forecast_models["models"]
+
+def update_forecast_models(sensor_id, reading):
+    """
+    Feeds every hourly value of a reading that is newer than what a model has
+    already seen into that model. Re-feeding the same response is a no-op.
+    """
+    with _forecast_lock:
+        models = _forecast_state()
+        for pollutant in DAQI_BREAKPOINTS:
+            if pollutant not in reading.pollutants:
+                continue
+            key = f"{sensor_id}:{pollutant}"
+            model = models.get(key)
+            for start, value in reading.observations(pollutant):
+                if model is None:
+                    model = models[key] = {"level": value, "trend": 0.0, "ts": start}
+                elif start > model["ts"]:
+                    steps = (start - model["ts"]) / 3600
+                    level = FORECAST_ALPHA * value + (1 - FORECAST_ALPHA) * (model["level"] + model["trend"] * steps)
+                    model["trend"] = FORECAST_BETA * (level - model["level"]) / steps + (1 - FORECAST_BETA) * model["trend"]
+                    model["level"] = level
+                    model["ts"] = start
+                else:
+                    continue
+                _forecast_models["dirty"] = True
+
+def save_forecast_models():
+    with _forecast_lock:
+        if not _forecast_models["dirty"]:
+            return
+        try:
+            tmp_path = FORECAST_STATE_PATH + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(_forecast_models["models"], f)
+            os.replace(tmp_path, FORECAST_STATE_PATH)
+            _forecast_models["dirty"] = False
+        except OSError as e:
+            logging.warning(f"Could not save forecast models: {e}")
+
+def predict_forecast_model(sensor_id, pollutant, target):
+    """
+    Predicts a pollutant's value for the hour starting at `target` (epoch
+    seconds) from the installation's model, or None if it has no model.
+    """
+    with _forecast_lock:
+        model = _forecast_state().get(f"{sensor_id}:{pollutant}")
+    if model is None:
+        return None
+    hours = max(0.0, (target - model["ts"]) / 3600)
+    damped = FORECAST_DAMPING * (1 - FORECAST_DAMPING ** hours) / (1 - FORECAST_DAMPING)
+    return max(0.0, model["level"] + model["trend"] * damped)
+
+def _predicted_value(result, pollutant, target):
+    """
+    Blends Airly's forecast and the local model for one sensor and hour.
+    """
+    local = predict_forecast_model(result["sensor_id"], pollutant, target)
+    airly = result.get("forecast", {}).get(pollutant, {}).get(target)
+    if local is not None and airly is not None:
+        return FORECAST_AIRLY_WEIGHT * airly + (1 - FORECAST_AIRLY_WEIGHT) * local
+    return airly if airly is not None else local
+
+def forecast_outlook(results, now=None):
+    """
+    Finds the worst DAQI level expected between FORECAST_MIN_HOURS and
+    FORECAST_MAX_HOURS ahead across a locality's sensors. Per sensor, the
+    observed hours are followed by predicted ones (Airly's forecast blended
+    with the local model) and rolled over each pollutant's DAQI averaging
+    period, so a predicted hour is banded like the current reading; the
+    network value is the mean over sensors. Returns {"daqi", "level",
+    "pollutant", "time"} for the earliest worst hour, or None when nothing
+    can be predicted.
+    """
+    now_ts = now.timestamp() if now else time.time()
+    base = now_ts // 3600 * 3600
+    first_target = base + FORECAST_MIN_HOURS * 3600
+    targets = FORECAST_MAX_HOURS - FORECAST_MIN_HOURS + 1
+    sensor_values = [{} for _ in range(targets)]
+    for pollutant, hours in DAQI_AVERAGING_HOURS.items():
+        start = first_target - (hours - 1) * 3600
+        for result in results:
+            observed = result.get("observed", {}).get(pollutant, {})
+            last_observed = max(observed, default=-math.inf)
+            series = array('d')
+            for hour in range(hours - 1 + targets):
+                hour_start = start + hour * 3600
+                if hour_start <= last_observed:
+                    value = observed.get(hour_start)
+                else:
+                    value = _predicted_value(result, pollutant, hour_start)
+                series.append(math.nan if value is None else value)
+            for target, value in enumerate(rolling_mean(series, hours)[hours - 1:]):
+                if value == value:
+                    sensor_values[target].setdefault(pollutant, []).append(value)
+
+    peak = None
+    for target, values in enumerate(sensor_values):
+        if not values:
+            continue
+        means = {p: sum(v) / len(v) for p, v in values.items()}
+        pollutant = max(means, key=lambda p: daqi_index(p, means[p]))
+        daqi = daqi_index(pollutant, means[pollutant])
+        if peak is None or daqi > peak["daqi"]:
+            peak = {"daqi": daqi, "level": DAQI_LEVELS[daqi], "pollutant": pollutant,
+                    "time": datetime.fromtimestamp(first_target + target * 3600)}
+    return peak
+
+def _forecast_period(when):
+    if when.hour < 12:
+        return "this morning"
+    elif when.hour < 14:
+        return "around lunchtime"
+    elif when.hour < 18:
+        return "this afternoon"
+    return "this evening"
+
+def forecast_note(results, overall_level, now=None):
+    """
+    Returns a sentence warning that levels are expected to rise above
+    `overall_level` later today, or "" if they are not.
+    """
+    outlook = forecast_outlook(results, now)
+    if not outlook or POLLUTION_LEVELS.index(outlook["level"]) <= POLLUTION_LEVELS.index(overall_level):
+        return ""
+    now = now or datetime.now()
+    if outlook["time"].date() != now.date():
+        return ""
+    return f" Levels may rise to {LEVEL_NAMES[outlook['level']]} {_forecast_period(outlook['time'])}."
+
+def compose_sensor_tweet(summary, locality, now=None, level=None):
+    """
+    Picks the overall level from an aggregate_readings summary and composes the
+    tweet text for a locality. Returns (tweet, overall_level, note).
+    Passing `level` overrides the level picked from the summary.
+    """
+    time_of_day = get_time_of_day(now)
+    level_avg = summary["level"]
+    level_max = summary["worst_level"]
 
     overall_level = level_avg
     note = ""
     if level_max != level_avg:
         overall_level = level_max
-        note = f" Note: {max_sensor_name} reports higher pollution levels."
+        note = f" Note: {summary['worst_sensor']} reports higher pollution levels."
+    if level:
+        overall_level = level
 
-    template = random.choice(TEMPLATES[overall_level])
+    template = random.choice(locality["templates"][overall_level])
 
     formatted_time = time_of_day
     if '{Time_of_day}' in template:
         formatted_time = time_of_day[0].upper() + time_of_day[1:]
-        tweet = template.format(time_of_day=time_of_day, Time_of_day=formatted_time)
+        tweet = template.format(time_of_day=time_of_day, Time_of_day=formatted_time, locality=locality["display_name"])
     else:
-        tweet = template.format(time_of_day=time_of_day)
+        tweet = template.format(time_of_day=time_of_day, locality=locality["display_name"])
 
-    return tweet + note
+    return tweet + note, overall_level, note
+
+def prepare_sensor_tweet(results=None, locality=None, now=None):
+    """
+    Prepares a tweet based on sensor data.
+    Determines the overall pollution level and randomly selects a tweet
+    from the corresponding pool. If an outlier sensor exists, a note is appended.
+    Sensor results are fetched unless already supplied (e.g. prefetched by the daemon).
+    The locality defaults to the first configured one.
+    """
+    locality = locality or load_localities()[0]
+    if results is None:
+        if locality.get("location"):
+            resolve_locality_sensors(locality)
+        results = get_air_quality_for_all_sensors(locality["sensors"])
+    with timed("quality"):
+        results = screen_readings(results, now.timestamp() if now else None)
+    with timed("aggregate_classify"):
+        summary = aggregate_readings(results) if results else None
+    if not summary:
+        return UNAVAILABLE_TWEET
+    with timed("compose"):
+        tweet, overall_level, _ = compose_sensor_tweet(summary, locality, now)
+    if FORECAST_ENABLED:
+        with timed("forecast"):
+            tweet += forecast_note(results, overall_level, now)
+    return tweet
 
 def prepare_fact_tweet():
     """
@@ -312,67 +1698,593 @@ def prepare_fact_tweet():
     fact = random.choice(FACTS)
     return fact
 
-def post_tweet(text):
+_twitter_clients = {}
+_twitter_client_lock = threading.Lock()
+
+def get_twitter_client(account=None):
     """
-    Posts the tweet using the Twitter API.
+    Returns the shared tweepy client for an account, creating it on first use
+    so its HTTP session stays warm across posts. An account is a prefix for the
+    TWITTER_* environment variables; None uses the unprefixed credentials.
     """
-    client = tweepy.Client(
-        consumer_key=TWITTER_API_KEY,
-        consumer_secret=TWITTER_API_SECRET_KEY,
-        access_token=TWITTER_ACCESS_TOKEN,
-        access_token_secret=TWITTER_ACCESS_TOKEN_SECRET
+    with _twitter_client_lock:
+        if account not in _twitter_clients:
+            if account:
+                credentials = [os.getenv(f"{account}_{name}") for name in (
+                    "TWITTER_API_KEY", "TWITTER_API_SECRET_KEY",
+                    "TWITTER_ACCESS_TOKEN", "TWITTER_ACCESS_TOKEN_SECRET")]
+            else:
+                credentials = [TWITTER_API_KEY, TWITTER_API_SECRET_KEY,
+                               TWITTER_ACCESS_TOKEN, TWITTER_ACCESS_TOKEN_SECRET]
+            _twitter_clients[account] = tweepy.Client(
+                consumer_key=credentials[0],
+                consumer_secret=credentials[1],
+                access_token=credentials[2],
+                access_token_secret=credentials[3]
+            )
+        return _twitter_clients[account]
+
+# --- Outbound Tweet Queue ---
+# Tweets are written to an on-disk outbox before posting, so a rate limit or a
+# transient Twitter error delays a post instead of dropping it, and pending
+# posts survive restarts. Rows are claimed ('sending') before they are posted,
+# so several processes sharing the outbox never post the same row twice.
+TWEET_QUEUE_PATH = os.getenv('TWEET_QUEUE_PATH', "tweet_queue.sqlite3")
+TWEET_DEDUP_WINDOW = int(os.getenv('TWEET_DEDUP_WINDOW', "86400"))
+TWEET_MAX_AGE = int(os.getenv('TWEET_MAX_AGE', "3600"))
+TWEET_MAX_ATTEMPTS = int(os.getenv('TWEET_MAX_ATTEMPTS', "5"))
+TWEET_RETRY_BASE_DELAY = float(os.getenv('TWEET_RETRY_BASE_DELAY', "30"))
+TWEET_RETRY_MAX_DELAY = float(os.getenv('TWEET_RETRY_MAX_DELAY', "900"))
+TWEET_MAX_CONCURRENCY = int(os.getenv('TWEET_MAX_CONCURRENCY', "2"))
+
+# Earliest time Twitter may be called again after a 429, per account.
+_twitter_rate_limit = {}
+
+def _tweet_queue_connect():
+    conn = sqlite3.connect(TWEET_QUEUE_PATH, timeout=10)
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS outbox ("
+        " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+        " text TEXT NOT NULL,"
+        " text_hash TEXT NOT NULL,"
+        " created_at REAL NOT NULL,"
+        " next_attempt_at REAL NOT NULL,"
+        " attempts INTEGER NOT NULL DEFAULT 0,"
+        " status TEXT NOT NULL DEFAULT 'pending',"
+        " tweet_id TEXT,"
+        " last_error TEXT,"
+        " account TEXT)"
     )
+    if "account" not in [row[1] for row in conn.execute("PRAGMA table_info(outbox)")]:
+        conn.execute("ALTER TABLE outbox ADD COLUMN account TEXT")
+    conn.execute("CREATE INDEX IF NOT EXISTS outbox_hash ON outbox (text_hash, created_at)")
+    return conn
+
+def enqueue_tweet(text, account=None):
+    """
+    Adds a tweet for an account to the outbox. Returns False without queueing
+    it if the account already queued or posted the same text within
+    TWEET_DEDUP_WINDOW seconds.
+    """
+    now = time.time()
+    text_hash = hashlib.sha256(text.encode("utf-8")).hexdigest()
+    conn = _tweet_queue_connect()
     try:
-        response = client.create_tweet(text=text)
-        tweet_id = response.data.get("id") if response.data else "unknown"
-        logging.info(f"Tweet posted successfully! Tweet ID: {tweet_id}")
+        with conn:
+            duplicate = conn.execute(
+                "SELECT 1 FROM outbox WHERE text_hash = ? AND created_at > ? AND status IN ('pending', 'sending', 'posted')"
+                " AND account IS ?",
+                (text_hash, now - TWEET_DEDUP_WINDOW, account)
+            ).fetchone()
+            if duplicate:
+                increment("tweets_deduplicated")
+                logging.info("Identical tweet already queued or posted recently. Skipping.")
+                return False
+            conn.execute(
+                "INSERT INTO outbox (text, text_hash, created_at, next_attempt_at, account) VALUES (?, ?, ?, ?, ?)",
+                (text, text_hash, now, now, account)
+            )
+    finally:
+        conn.close()
+    return True
+
+def _rate_limit_reset(error):
+    """
+    Returns the epoch time from a 429 response's x-rate-limit-reset header,
+    falling back to 15 minutes (Twitter's rate limit window).
+    """
+    response = getattr(error, "response", None)
+    try:
+        return float(response.headers["x-rate-limit-reset"])
+    except (AttributeError, KeyError, TypeError, ValueError):
+        return time.time() + 900
+
+def _send_tweet(text, account=None):
+    """
+    Makes one posting attempt. Returns (outcome, detail, retry_at) where outcome
+    is "posted", "retry" or "failed"; retry_at is only set for "retry".
+    """
+    blocked_until = _twitter_rate_limit.get(account, 0.0)
+    if time.time() < blocked_until:
+        return "retry", "rate limited", blocked_until
+    try:
+        with timed("twitter_post"):
+            response = get_twitter_client(account).create_tweet(text=text)
+    except tweepy.TooManyRequests as e:
+        reset = _rate_limit_reset(e)
+        _twitter_rate_limit[account] = max(_twitter_rate_limit.get(account, 0.0), reset)
+        return "retry", str(e), reset
+    except (tweepy.TwitterServerError, requests.RequestException) as e:
+        return "retry", str(e), None
     except Exception as e:
+        return "failed", str(e), None
+    tweet_id = response.data.get("id") if response.data else "unknown"
+    return "posted", str(tweet_id), None
+
+def flush_tweet_queue():
+    """
+    Posts every due tweet in the outbox, at most TWEET_MAX_CONCURRENCY at a time.
+    Rate-limited posts are retried after x-rate-limit-reset, transient errors
+    with exponential backoff, and posts older than TWEET_MAX_AGE are dropped.
+    Returns the number of tweets posted.
+    """
+    now = time.time()
+    conn = _tweet_queue_connect()
+    try:
+        with conn:
+            expired = conn.execute(
+                "UPDATE outbox SET status = 'expired' WHERE status IN ('pending', 'sending') AND created_at < ?",
+                (now - TWEET_MAX_AGE,)
+            ).rowcount
+        if expired:
+            increment("tweets_expired", expired)
+            logging.warning(f"Dropped {expired} queued tweet(s) older than {TWEET_MAX_AGE}s.")
+        rows = conn.execute(
+            "SELECT id, text, attempts, account FROM outbox WHERE status = 'pending' AND next_attempt_at <= ? ORDER BY id",
+            (now,)
+        ).fetchall()
+        with conn:
+            rows = [row for row in rows if conn.execute(
+                "UPDATE outbox SET status = 'sending' WHERE id = ? AND status = 'pending'", (row[0],)
+            ).rowcount == 1]
+        if not rows:
+            return 0
+
+        with ThreadPoolExecutor(max_workers=min(TWEET_MAX_CONCURRENCY, len(rows))) as executor:
+            outcomes = list(executor.map(lambda row: _send_tweet(row[1], row[3]), rows))
+
+        posted = 0
+        with conn:
+            for (row_id, text, attempts, account), (outcome, detail, retry_at) in zip(rows, outcomes):
+                attempts += 1
+                increment(f"tweets_{outcome}")
+                if outcome == "posted":
+                    posted += 1
+                    logging.info(f"Tweet posted successfully! Tweet ID: {detail}")
+                    conn.execute("UPDATE outbox SET status = 'posted', attempts = ?, tweet_id = ? WHERE id = ?",
+                                 (attempts, detail, row_id))
+                elif outcome == "retry" and attempts < TWEET_MAX_ATTEMPTS:
+                    if retry_at is None:
+                        delay = min(TWEET_RETRY_MAX_DELAY, TWEET_RETRY_BASE_DELAY * 2 ** (attempts - 1))
+                        retry_at = time.time() + delay * random.uniform(0.8, 1.2)
+                    logging.warning(f"Error posting tweet, retrying at {datetime.fromtimestamp(retry_at)}: {detail}")
+                    conn.execute("UPDATE outbox SET status = 'pending', attempts = ?, next_attempt_at = ?, last_error = ?"
+                                 " WHERE id = ?",
+                                 (attempts, retry_at, detail, row_id))
+                else:
+                    if outcome == "retry":
+                        increment("tweets_gave_up")
+                    logging.error(f"Error posting tweet: {detail}")
+                    conn.execute("UPDATE outbox SET status = 'failed', attempts = ?, last_error = ? WHERE id = ?",
+                                 (attempts, detail, row_id))
+        return posted
+    finally:
+        conn.close()
+
+def post_tweet(text, account=None):
+    """
+    Queues the tweet and posts everything due in the outbox using the Twitter API.
+    """
+    try:
+        if enqueue_tweet(text, account):
+            flush_tweet_queue()
+    except sqlite3.Error as e:
         logging.error(f"Error posting tweet: {e}")
 
-def sensor_tweet_job():
-    tweet_text = prepare_sensor_tweet()
-    logging.info(f"Sensor Tweet: {tweet_text}")
-    post_tweet(tweet_text)
+def sensor_tweet_job(results=None, locality=None):
+    locality = locality or load_localities()[0]
+    tweet_text = prepare_sensor_tweet(results, locality)
+    logging.info(f"Sensor Tweet ({locality['name']}): {tweet_text}")
+    post_tweet(tweet_text, locality["account"])
 
-def fact_tweet_job():
+def fact_tweet_job(locality=None):
+    locality = locality or load_localities()[0]
     tweet_text = prepare_fact_tweet()
-    logging.info(f"Fact Tweet: {tweet_text}")
-    post_tweet(tweet_text) # Changed "text" to "tweet_text"
+    logging.info(f"Fact Tweet ({locality['name']}): {tweet_text}")
+    post_tweet(tweet_text, locality["account"]) # Changed "text" to "tweet_text"
+
+# --- Tweet Schedule ---
+# Each window starts at "time" (local, HH:MM) and lasts one hour. main() posts
+# if it is started inside a window; the daemon posts exactly at its start.
+# Localities without their own "schedule" use this one.
+TWEET_SCHEDULE = [
+    {"name": "morning", "time": "08:00", "job": "sensor"},
+    {"name": "midday", "time": "12:00", "job": "sensor"},
+    {"name": "afternoon", "time": "16:00", "job": "sensor"},
+    {"name": "evening", "time": "19:00", "job": "fact"},
+]
+
+DAEMON_PREFETCH_SECONDS = int(os.getenv('DAEMON_PREFETCH_SECONDS', "300"))
+DAEMON_QUEUE_FLUSH_SECONDS = int(os.getenv('DAEMON_QUEUE_FLUSH_SECONDS', "60"))
+
+def _window_start(window, day):
+    hour, minute = (int(part) for part in window["time"].split(":"))
+    return day.replace(hour=hour, minute=minute, second=0, microsecond=0)
+
+def find_tweet_window(now, schedule=None):
+    """
+    Returns the schedule entry (TWEET_SCHEDULE by default) whose one-hour
+    window contains `now`, or None.
+    """
+    for window in schedule or TWEET_SCHEDULE:
+        start = _window_start(window, now)
+        if start <= now < start + timedelta(hours=1):
+            return window
+    return None
+
+def run_tweet_windows(due, results_by_id=None):
+    """
+    Runs a list of (locality, window) pairs. Sensor data for every locality
+    with a sensor window is fetched in one shared batch unless supplied.
+    """
+    sensor_localities = [locality for locality, window in due if window["job"] == "sensor"]
+    if results_by_id is None:
+        for locality in sensor_localities:
+            if locality.get("location"):
+                resolve_locality_sensors(locality)
+    if sensor_localities and results_by_id is None:
+        results_by_id = get_air_quality_for_localities(sensor_localities)
+    for locality, window in due:
+        try:
+            if window["job"] == "sensor":
+                sensor_tweet_job(locality_results(locality, results_by_id), locality)
+            else:
+                fact_tweet_job(locality)
+        except Exception as e:
+            logging.error(f"Error running {window['name']} window for {locality['name']}: {e}")
 
 
 
 def main():
     """
-    Checks the current time and sends a tweet if within one of the designated windows:
+    Checks the current time and sends a tweet for every locality that is within
+    one of its designated windows. With the default schedule these are:
         - Morning sensor tweet between 08:00 and 09:00
         - Midday sensor tweet between 12:00 and 13:00
         - Afternoon sensor tweet between 16:00 and 17:00
-        - Fact tweet between 18:00 and 19:00
+        - Fact tweet between 19:00 and 20:00
     If the current time is outside any window, nothing is sent.
     """
     now = datetime.now()
-    current_hour = now.hour
-
-
-
-    if 8 <= current_hour < 9:
-        logging.info("Within morning window. Sending sensor tweet.")
-        sensor_tweet_job()
-    elif 12 <= current_hour < 13:
-        logging.info("Within midday window. Sending sensor tweet.")
-        sensor_tweet_job()
-    elif 16 <= current_hour < 17:
-        logging.info("Within afternoon window. Sending sensor tweet.")
-        sensor_tweet_job()
-    elif 19 <= current_hour < 20:
-        logging.info("Within evening window. Sending fact tweet.")
-        fact_tweet_job()
+    due = []
+    for locality in load_localities():
+        window = find_tweet_window(now, locality["schedule"])
+        if window:
+            logging.info(f"{locality['display_name']} is within {window['name']} window. Sending {window['job']} tweet.")
+            due.append((locality, window))
+    if due:
+        run_tweet_windows(due)
     else:
         logging.info("Current time not in any tweet window. No tweet will be sent.")
+        flush_tweet_queue()
 
-if __name__ == "__main__":
-    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
-    main()
+def run_daemon():
+    """
+    Stays resident and posts at the exact start of every scheduled window of
+    every locality. Localities posting at the same time share one Airly batch,
+    prefetched DAEMON_PREFETCH_SECONDS before the window, and the Airly session
+    and Twitter clients are kept warm between posts.
+    Tweets waiting for a retry are flushed every DAEMON_QUEUE_FLUSH_SECONDS.
+    """
+    scheduler = sched.scheduler(time.time, time.sleep)
+    prefetched = {}
+    localities = load_localities()
+
+    # Group windows by start time so each time slot runs as one batch.
+    slots = {}
+    for locality in localities:
+        for window in locality["schedule"]:
+            slots.setdefault(window["time"], []).append((locality, window))
+
+    def flush_queue():
+        try:
+            flush_tweet_queue()
+        except Exception as e:
+            logging.error(f"Error flushing tweet queue: {e}")
+        scheduler.enter(DAEMON_QUEUE_FLUSH_SECONDS, 2, flush_queue)
+
+    def prefetch(slot):
+        sensor_localities = [locality for locality, window in slots[slot] if window["job"] == "sensor"]
+        try:
+            for locality in sensor_localities:
+                if locality.get("location"):
+                    resolve_locality_sensors(locality)
+            prefetched[slot] = get_air_quality_for_localities(sensor_localities)
+            logging.info(f"Prefetched sensor data for the {slot} windows.")
+        except Exception as e:
+            logging.error(f"Error prefetching sensor data: {e}")
+
+    def fire(slot):
+        logging.info(f"Starting {slot} windows: " + ", ".join(
+            f"{locality['name']}/{window['name']}" for locality, window in slots[slot]))
+        try:
+            run_tweet_windows(slots[slot], prefetched.pop(slot, None))
+            write_metrics()
+        except Exception as e:
+            logging.error(f"Error running the {slot} windows: {e}")
+        finally:
+            schedule(slot)
+
+    def schedule(slot):
+        now = datetime.now()
+        start = _window_start(slots[slot][0][1], now)
+        if start <= now:
+            start = _window_start(slots[slot][0][1], now + timedelta(days=1))
+        scheduler.enterabs(start.timestamp(), 1, fire, (slot,))
+        if any(window["job"] == "sensor" for _, window in slots[slot]):
+            prefetch_at = max(time.time(), start.timestamp() - DAEMON_PREFETCH_SECONDS)
+            scheduler.enterabs(prefetch_at, 0, prefetch, (slot,))
+        logging.info(f"Next {slot} windows scheduled for {start}.")
+
+    get_airly_session()
+    for locality in localities:
+        get_twitter_client(locality["account"])
+    for slot in slots:
+        schedule(slot)
+    scheduler.enter(0, 2, flush_queue)
+    try:
+        scheduler.run()
+    except KeyboardInterrupt:
+        logging.info("Daemon stopped.")
+
+# --- Threshold Alerts ---
+# Between the scheduled windows, --alert polls the sensors (through the
+# measurement cache) and posts as soon as a locality's level changes. Levels
+# rise as soon as the DAQI index enters a higher band but only fall once it is
+# ALERT_HYSTERESIS indexes below the current band, and a locality posts at most
+# one alert per ALERT_COOLDOWN seconds, so readings hovering on a band edge do
+# not flap. State is kept in ALERT_STATE_PATH so it survives restarts.
+ALERT_POLL_INTERVAL = int(os.getenv('ALERT_POLL_INTERVAL', "600"))
+ALERT_COOLDOWN = int(os.getenv('ALERT_COOLDOWN', "3600"))
+ALERT_HYSTERESIS = int(os.getenv('ALERT_HYSTERESIS', "1"))
+ALERT_STATE_PATH = os.getenv('ALERT_STATE_PATH', "alert_state.json")
+
+# Lowest DAQI index of each level.
+LEVEL_LOWEST_DAQI = {level: DAQI_LEVELS.index(level) for level in POLLUTION_LEVELS}
+
+def hysteresis_level(previous_level, daqi):
+    """
+    Returns the level for a new DAQI index given the previously held level:
+    rises immediately, falls only once the index is clearly below the band.
+    """
+    level = DAQI_LEVELS[daqi]
+    if previous_level is None or POLLUTION_LEVELS.index(level) >= POLLUTION_LEVELS.index(previous_level):
+        return level
+    if daqi <= LEVEL_LOWEST_DAQI[previous_level] - ALERT_HYSTERESIS:
+        return level
+    return previous_level
+
+def load_alert_state():
+    try:
+        with open(ALERT_STATE_PATH, encoding="utf-8") as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {"localities": {}, "sensors": {}}
+
+def save_alert_state(state):
+    tmp_path = ALERT_STATE_PATH + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(state, f)
+    os.replace(tmp_path, ALERT_STATE_PATH)
+
+def check_alerts(localities=None, state=None, now=None):
+    """
+    Polls every locality once and updates the per-sensor and per-locality alert
+    state. A locality posts an alert when its level differs from the last level
+    it announced and its cooldown has passed. The first poll of a locality only
+    records its level, without starting the cooldown. Returns the list of (locality, level) alerts posted.
+    """
+    localities = localities or load_localities()
+    state = state or load_alert_state()
+    now = time.time() if now is None else now
+    for locality in localities:
+        if locality.get("location"):
+            resolve_locality_sensors(locality)
+    results_by_id = get_air_quality_for_localities(localities)
+
+    posted = []
+    for locality in localities:
+        results = screen_readings(locality_results(locality, results_by_id), now)
+        summary = aggregate_readings(results) if results else None
+        if not summary:
+            continue
+
+        for result, daqi in zip(results, summary["sensor_daqi"]):
+            sensor_state = state["sensors"].setdefault(str(result["sensor_id"]), {})
+            level = hysteresis_level(sensor_state.get("level"), daqi)
+            if sensor_state.get("level") not in (None, level):
+                logging.info(f"{result['sensor_name']} moved from {sensor_state['level']} to {level}.")
+            sensor_state.update(level=level, daqi=daqi, updated_at=now)
 
+        locality_state = state["localities"].setdefault(locality["name"], {})
+        level = hysteresis_level(locality_state.get("level"), max(summary["sensor_daqi"]))
+        locality_state.update(level=level, updated_at=now)
+        announced = locality_state.get("announced_level")
+        if announced is None:
+            # A baseline, not an announcement: it does not start the cooldown.
+            locality_state.update(announced_level=level, announced_at=0)
+        elif level != announced and now - locality_state.get("announced_at", 0) >= ALERT_COOLDOWN:
+            tweet = compose_sensor_tweet(summary, locality, datetime.fromtimestamp(now), level)[0]
+            logging.info(f"Alert ({locality['name']}): level changed from {announced} to {level}. {tweet}")
+            post_tweet(tweet, locality["account"])
+            locality_state.update(announced_level=level, announced_at=now)
+            posted.append((locality, level))
+    save_alert_state(state)
+    return posted
 
+def run_alerts():
+    """
+    Polls for level changes every ALERT_POLL_INTERVAL seconds until interrupted.
+    """
+    localities = load_localities()
+    try:
+        while True:
+            try:
+                check_alerts(localities)
+                flush_tweet_queue()
+                write_metrics()
+            except Exception as e:
+                logging.error(f"Error checking alerts: {e}")
+            time.sleep(ALERT_POLL_INTERVAL)
+    except KeyboardInterrupt:
+        logging.info("Alert mode stopped.")
+
+# --- Replay / Backtest ---
+# Recorded responses (see AIRLY_RECORD_PATH) are streamed back through the same
+# parse -> aggregate -> classify -> compose steps with the recording time as the
+# clock, so threshold and template changes can be evaluated offline.
+REPLAY_RUN_GAP = 300  # records further apart than this belong to separate runs
+
+def _recording_files(path):
+    if not os.path.isdir(path):
+        return [path]
+    return [os.path.join(path, name) for name in sorted(os.listdir(path))
+            if name.endswith((".json", ".jsonl", ".json.gz", ".jsonl.gz"))]
+
+def iter_recorded_responses(path):
+    """
+    Yields recorded {"installationId", "fetchedAt", "response"} records from a
+    JSONL file (optionally gzip-compressed), a JSON file holding one record or a
+    list of them, or a directory of such files read in name order.
+    """
+    for file_path in _recording_files(path):
+        with _open_recording(file_path, "r") as f:
+            if file_path.endswith((".json", ".json.gz")):
+                records = json.load(f)
+                yield from records if isinstance(records, list) else [records]
+            else:
+                for line in f:
+                    if line.strip():
+                        yield json.loads(line)
 
+def _record_time(record):
+    fetched_at = record["fetchedAt"]
+    return fetched_at if isinstance(fetched_at, (int, float)) else parse_airly_time(fetched_at)
+
+def _group_runs(records, run_gap):
+    """
+    Groups a chronological record stream into runs: batches fetched together.
+    """
+    run = {}
+    run_start = None
+    for record in records:
+        fetched_at = _record_time(record)
+        if run and fetched_at - run_start > run_gap:
+            yield run_start, run
+            run = {}
+        if not run:
+            run_start = fetched_at
+        run[record["installationId"]] = record["response"]
+    if run:
+        yield run_start, run
+
+def replay(path, localities=None, output=None, run_gap=REPLAY_RUN_GAP, audit_path=""):
+    """
+    Replays recorded responses for every locality whose sensors appear in them.
+    Each decision is written to `output` (a file object) as a JSON line, and
+    data-quality rejections to `audit_path` if set (never the live audit log).
+    Returns summary statistics: level and DAQI distributions and how often
+    the outlier note or the unavailable message would have been posted.
+    Located localities take their sensors from INSTALLATIONS_CACHE_PATH;
+    any left with no sensors are listed under "unresolved_localities".
+    """
+    localities = localities or load_localities()
+    stats = {"runs": 0, "decisions": 0, "unavailable": 0, "notes": 0, "levels": {}, "daqi": {},
+             "unresolved_localities": []}
+    # Located localities use the installations cached on disk, never a download.
+    resolved = []
+    for locality in localities:
+        if locality.get("location"):
+            resolve_locality_sensors(locality, offline=True)
+        if locality["sensors"]:
+            resolved.append(locality)
+        else:
+            logging.warning(f"No sensors for {locality['name']} in {INSTALLATIONS_CACHE_PATH} or its config; "
+                            f"it is left out of the replay.")
+            stats["unresolved_localities"].append(locality["name"])
+    localities = resolved
+    # Forecast models are rebuilt from the recording alone and never saved.
+    _forecast_models.update(loaded=True, dirty=False, models={})
+    for run_start, responses in _group_runs(iter_recorded_responses(path), run_gap):
+        stats["runs"] += 1
+        now = datetime.fromtimestamp(run_start)
+        for locality in localities:
+            results = []
+            for sensor in locality["sensors"]:
+                if sensor["id"] in responses:
+                    reading = AirlyReading.from_response(sensor["id"], responses[sensor["id"]])
+                    update_quality_windows(sensor["id"], reading)
+                    if FORECAST_ENABLED:
+                        update_forecast_models(sensor["id"], reading)
+                    results.append(parse_air_quality(sensor, reading, run_start, use_history=False))
+            results = screen_readings(results, run_start, audit_path)
+            summary = aggregate_readings(results) if results else None
+            decision = {"time": now.isoformat(), "locality": locality["name"], "sensors": len(results)}
+            if summary:
+                tweet, level, note = compose_sensor_tweet(summary, locality, now)
+                if FORECAST_ENABLED:
+                    tweet += forecast_note(results, level, now)
+                decision.update(daqi=summary["daqi"], level=level, worst_sensor=summary["worst_sensor"],
+                                note=bool(note), tweet=tweet)
+                stats["levels"][level] = stats["levels"].get(level, 0) + 1
+                stats["daqi"][summary["daqi"]] = stats["daqi"].get(summary["daqi"], 0) + 1
+                stats["notes"] += bool(note)
+            else:
+                decision.update(daqi=None, level=None, note=False, tweet=UNAVAILABLE_TWEET)
+                stats["unavailable"] += 1
+            stats["decisions"] += 1
+            if output:
+                output.write(json.dumps(decision, ensure_ascii=False) + "\n")
+    stats["note_rate"] = stats["notes"] / stats["decisions"] if stats["decisions"] else 0.0
+    return stats
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description="Water Orton air quality bot.")
+    parser.add_argument("--daemon", action="store_true", help="stay resident and post at the scheduled times")
+    parser.add_argument("--alert", action="store_true", help="poll continuously and post when a level changes")
+    parser.add_argument("--alert-once", action="store_true", help="run a single alert poll (e.g. from cron)")
+    parser.add_argument("--replay", metavar="PATH", help="backtest recorded Airly responses instead of posting")
+    parser.add_argument("--replay-output", metavar="FILE", help="write each replayed decision to FILE as JSON lines")
+    parser.add_argument("--replay-audit", metavar="FILE", default="",
+                        help="write data-quality rejections seen during the replay to FILE as JSON lines")
+    parser.add_argument("--seed", type=int, help="seed template selection for reproducible replays")
+    args = parser.parse_args()
+    if args.seed is not None:
+        random.seed(args.seed)
+    if args.replay:
+        if args.replay_output:
+            with open(args.replay_output, "w", encoding="utf-8") as output:
+                stats = replay(args.replay, output=output, audit_path=args.replay_audit)
+        else:
+            stats = replay(args.replay, audit_path=args.replay_audit)
+        print(json.dumps(stats, indent=2))
+    elif args.alert:
+        run_alerts()
+    elif args.alert_once:
+        check_alerts()
+    elif args.daemon:
+        run_daemon()
+    else:
+        main()
+    write_metrics()
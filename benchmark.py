@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+"""
+Benchmarks the fetch -> classify -> post pipeline of WaterOrtonAQI.py against
+a local mock of the Airly and Twitter APIs.
+
+The mock runs in a separate process so it does not compete with the bot for
+the GIL. Every installation gets a deterministic synthetic response, so runs
+with the same arguments are reproducible. Each sensor count is run twice:
+cold (empty cache) and warm (everything served from the measurement cache).
+
+    python benchmark.py --sizes 5 500 50000 --latency 0.05 --workers 64
+"""
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import random
+import tempfile
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import requests
+
+import WaterOrtonAQI as bot
+
+# --- Mock Airly / Twitter Server ---
+
+def synthetic_response(installation_id, history_hours=24):
+    """
+    Builds a deterministic Airly-shaped measurement response for an installation.
+    """
+    rng = random.Random(installation_id)
+    hour = int(time.time()) // 3600 * 3600
+
+    def entry(start):
+        return {
+            "fromDateTime": time.strftime("%Y-%m-%dT%H:%M:%S.000Z", time.gmtime(start)),
+            "tillDateTime": time.strftime("%Y-%m-%dT%H:%M:%S.000Z", time.gmtime(start + 3600)),
+            "values": [
+                {"name": "PM1", "value": round(rng.uniform(1, 30), 2)},
+                {"name": "PM25", "value": round(rng.uniform(1, 60), 2)},
+                {"name": "PM10", "value": round(rng.uniform(1, 80), 2)},
+                {"name": "NO2", "value": round(rng.uniform(1, 150), 2)},
+                {"name": "O3", "value": round(rng.uniform(1, 120), 2)},
+                {"name": "TEMPERATURE", "value": round(rng.uniform(-5, 25), 2)},
+            ],
+        }
+
+    return {
+        "current": entry(hour - 3600),
+        "history": [entry(hour - 3600 * (i + 2)) for i in reversed(range(history_hours))],
+        "forecast": [],
+    }
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    latency = 0.0
+    history_hours = 24
+
+    def log_message(self, *args):
+        pass
+
+    def _send_json(self, status, payload):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        time.sleep(self.latency)
+        query = parse_qs(urlparse(self.path).query)
+        installation_id = int(query.get("installationId", ["0"])[0])
+        self._send_json(200, synthetic_response(installation_id, self.history_hours))
+
+    def do_POST(self):
+        time.sleep(self.latency)
+        length = int(self.headers.get("Content-Length", 0))
+        text = json.loads(self.rfile.read(length) or b"{}").get("text", "")
+        self._send_json(201, {"data": {"id": str(abs(hash(text))), "text": text}})
+
+def serve_mock(port_queue, latency, history_hours):
+    MockHandler.latency = latency
+    MockHandler.history_hours = history_hours
+    server = ThreadingHTTPServer(("127.0.0.1", 0), MockHandler)
+    server.daemon_threads = True
+    port_queue.put(server.server_port)
+    server.serve_forever()
+
+class MockTwitterClient:
+    """
+    Stands in for tweepy.Client, posting to the mock server instead of Twitter.
+    """
+    def __init__(self, base_url):
+        self.url = f"{base_url}/2/tweets"
+        self.session = requests.Session()
+
+    def create_tweet(self, text):
+        response = self.session.post(self.url, json={"text": text}, timeout=10)
+        response.raise_for_status()
+        return type("Response", (), {"data": response.json()["data"]})()
+
+# --- Benchmark ---
+
+def run_size(size, base_url, workers, with_history, workdir):
+    """
+    Runs one cold and one warm sensor window over `size` installations.
+    Returns {"cold": {...}, "warm": {...}} with wall time and metrics.
+    """
+    bot.AIRLY_API_URL = base_url
+    bot.AIRLY_MAX_WORKERS = workers
+    bot.AIRLY_BATCH_DEADLINE = 3600
+    bot.AIRLY_CACHE_PATH = os.path.join(workdir, "cache.sqlite3")
+    bot.HISTORY_DIR = os.path.join(workdir, "history") if with_history else ""
+    bot.TWEET_QUEUE_PATH = os.path.join(workdir, "queue.sqlite3")
+    bot.TWEET_DEDUP_WINDOW = 0
+    bot.FORECAST_STATE_PATH = os.path.join(workdir, "forecast.json")
+    bot.QC_AUDIT_PATH = os.path.join(workdir, "quality_rejections.jsonl")
+    bot._forecast_models.update(loaded=False, dirty=False, models={})
+    bot._airly_session = None
+    bot._twitter_clients[None] = MockTwitterClient(base_url)
+
+    locality = {
+        "name": f"bench-{size}",
+        "display_name": "Benchtown",
+        "sensors": [{"id": 100000 + i, "name": f"Sensor {i}"} for i in range(size)],
+        "templates": bot.TEMPLATES,
+        "schedule": [{"name": "bench", "time": "00:00", "job": "sensor"}],
+        "account": None,
+    }
+    window = locality["schedule"][0]
+
+    results = {}
+    for phase in ("cold", "warm"):
+        bot.reset_metrics()
+        random.seed(size)
+        start = time.perf_counter()
+        bot.run_tweet_windows([(locality, window)])
+        elapsed = time.perf_counter() - start
+        results[phase] = {"wall_seconds": elapsed, "sensors_per_second": size / elapsed, **bot.metrics_snapshot()}
+    return results
+
+def print_report(size, results):
+    for phase, result in results.items():
+        print(f"\n== {size} sensors, {phase}: {result['wall_seconds']:.3f}s "
+              f"({result['sensors_per_second']:.0f} sensors/s)")
+        for stage, timer in sorted(result["timers"].items()):
+            print(f"  {stage:<20} n={timer['count']:<7} total={timer['sum']:.3f}s "
+                  f"p50={timer['p50'] * 1000:.2f}ms p99={timer['p99'] * 1000:.2f}ms")
+        for name, value in sorted(result["counters"].items()):
+            print(f"  {name:<28} {value}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the air quality pipeline against a local mock API.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[5, 500, 50000], help="sensor counts to run")
+    parser.add_argument("--latency", type=float, default=0.05, help="mock API latency per request, in seconds")
+    parser.add_argument("--workers", type=int, default=bot.AIRLY_MAX_WORKERS, help="concurrent Airly requests")
+    parser.add_argument("--history-hours", type=int, default=24, help="history entries per mock response")
+    parser.add_argument("--with-history", action="store_true", help="also write the on-disk history store")
+    parser.add_argument("--json", metavar="FILE", help="write all results to FILE as JSON")
+    args = parser.parse_args()
+
+    port_queue = multiprocessing.Queue()
+    server = multiprocessing.Process(target=serve_mock, args=(port_queue, args.latency, args.history_hours), daemon=True)
+    server.start()
+    base_url = f"http://127.0.0.1:{port_queue.get(timeout=10)}"
+
+    report = {"latency": args.latency, "workers": args.workers, "sizes": {}}
+    try:
+        for size in args.sizes:
+            with tempfile.TemporaryDirectory() as workdir:
+                report["sizes"][size] = run_size(size, base_url, args.workers, args.with_history, workdir)
+            print_report(size, report["sizes"][size])
+    finally:
+        server.terminate()
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.WARNING, format='%(asctime)s - %(levelname)s - %(message)s')
+    main()
@@ -0,0 +1,76 @@
+"""
+Checks the DAQI tables and classification against DEFRA's published bands
+(https://uk-air.defra.gov.uk/air-pollution/daqi?view=more-info), typed out
+here independently of DAQI_BREAKPOINTS.
+"""
+import math
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import WaterOrtonAQI as bot
+
+# Index 1-10 -> inclusive (low, high) concentration in µg/m³; index 10 is open-ended.
+DEFRA_BANDS = {
+    "O3": ((0, 33), (34, 66), (67, 100), (101, 120), (121, 140),
+           (141, 160), (161, 187), (188, 213), (214, 240), (241, None)),
+    "NO2": ((0, 67), (68, 134), (135, 200), (201, 267), (268, 334),
+            (335, 400), (401, 467), (468, 534), (535, 600), (601, None)),
+    "SO2": ((0, 88), (89, 177), (178, 265), (266, 354), (355, 443),
+            (444, 532), (533, 710), (711, 887), (888, 1064), (1065, None)),
+    "PM2.5": ((0, 11), (12, 23), (24, 35), (36, 41), (42, 47),
+              (48, 53), (54, 58), (59, 64), (65, 70), (71, None)),
+    "PM10": ((0, 16), (17, 33), (34, 50), (51, 58), (59, 66),
+             (67, 75), (76, 83), (84, 91), (92, 100), (101, None)),
+}
+
+class DaqiBandsTest(unittest.TestCase):
+    def test_tables_cover_the_same_pollutants(self):
+        self.assertEqual(set(bot.DAQI_BREAKPOINTS), set(DEFRA_BANDS))
+        self.assertEqual(set(bot.DAQI_AVERAGING_HOURS), set(DEFRA_BANDS))
+
+    def test_band_edges(self):
+        for pollutant, bands in DEFRA_BANDS.items():
+            for index, (low, high) in enumerate(bands, start=1):
+                with self.subTest(pollutant=pollutant, index=index):
+                    self.assertEqual(bot.daqi_index(pollutant, low), index)
+                    if high is not None:
+                        self.assertEqual(bot.daqi_index(pollutant, high), index)
+                        self.assertEqual(bot.daqi_index(pollutant, high + 1), index + 1)
+            self.assertEqual(bot.daqi_index(pollutant, 100000), 10)
+
+    def test_daqi_indices_matches_daqi_index(self):
+        for pollutant, bands in DEFRA_BANDS.items():
+            values = [math.nan] + [v for low, high in bands for v in (low, high) if v is not None]
+            indices = bot.daqi_indices(pollutant, values)
+            self.assertEqual(indices[0], 0)
+            self.assertEqual(list(indices[1:]), [bot.daqi_index(pollutant, v) for v in values[1:]])
+
+    def test_rounding_of_halves(self):
+        # Concentrations are rounded to whole µg/m³ half-to-even before banding.
+        self.assertEqual(bot.daqi_index("PM2.5", 11.4), 1)
+        self.assertEqual(bot.daqi_index("PM2.5", 11.5), 2)
+        self.assertEqual(bot.daqi_index("PM2.5", 12.5), 2)
+        self.assertEqual(bot.daqi_index("PM2.5", 35.5), 4)
+        self.assertEqual(bot.daqi_index("SO2", 265.5), 4)
+        self.assertEqual(list(bot.daqi_indices("PM2.5", [12.5, 35.5])), [2, 4])
+
+    def test_missing_values(self):
+        self.assertIsNone(bot.daqi_index("PM2.5", None))
+        self.assertIsNone(bot.daqi_index("PM2.5", math.nan))
+        self.assertIsNone(bot.daqi_index("PM1", 50))
+        self.assertIsNone(bot.overall_daqi({"PM1": 50}))
+        self.assertEqual(bot.overall_daqi({"PM2.5": 20, "NO2": 300, "PM1": 900}), 5)
+
+    def test_levels(self):
+        self.assertEqual(len(bot.DAQI_LEVELS), 11)
+        self.assertEqual(bot.DAQI_LEVELS[1:4], ("low",) * 3)
+        self.assertEqual(bot.DAQI_LEVELS[4:7], ("mediocre",) * 3)
+        self.assertEqual(bot.DAQI_LEVELS[7:10], ("high",) * 3)
+        self.assertEqual(bot.DAQI_LEVELS[10], "emergency")
+        self.assertEqual(bot.determine_pollution_level({"PM2.5": 71}), "emergency")
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,77 @@
+"""
+Checks that the streaming Airly parser (scan_airly_response) builds the same
+AirlyReading as decoding the whole response with json and AirlyReading.from_response.
+"""
+import json
+import math
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import WaterOrtonAQI as bot
+
+def entry(start, values):
+    return {
+        "fromDateTime": f"2024-01-31T{start:02d}:00:00.000Z",
+        "tillDateTime": f"2024-01-31T{start + 1:02d}:00:00.000Z",
+        "values": [{"name": name, "value": value} for name, value in values],
+        "indexes": [{"name": "AIRLY_CAQI", "value": 21.5, "level": "LOW", "description": "Air is \"good\" \\ fine"}],
+        "standards": [],
+    }
+
+RESPONSE = {
+    "current": entry(10, [("PM1", 3.1), ("PM25", 7.25), ("PM10", 12), ("NO2", 40.5), ("TEMPERATURE", -1.5)]),
+    "history": [
+        entry(hour, [("PM25", 5.0 + hour), ("PM10", None), ("O3", 60 - hour), ("PRESSURE", 1013.2)])
+        for hour in range(10)
+    ] + [{"fromDateTime": None, "tillDateTime": None, "values": []}],
+    "forecast": [
+        entry(hour, [("PM25", 9.5 + hour), ("PM10", 14.0), ("SO2", 3e1)])
+        for hour in range(11, 14)
+    ],
+    "extra": {"nested": [1, 2.5e-3, True, None, "ä ☃  "]},
+}
+
+def _plain(values):
+    return ["nan" if math.isnan(value) else value for value in values]
+
+class ScanAirlyResponseTest(unittest.TestCase):
+    def assertSameReading(self, body, keep_forecast):
+        streamed = bot.scan_airly_response(118480, body, keep_forecast=keep_forecast)
+        decoded = json.loads(body)
+        if not keep_forecast:
+            decoded = dict(decoded, forecast=[])
+        expected = bot.AirlyReading.from_response(118480, decoded)
+        for name in ("installation_id", "pollutants", "from_time", "till_time"):
+            self.assertEqual(getattr(streamed, name), getattr(expected, name), name)
+        for name in ("values", "history", "history_times", "forecast", "forecast_times"):
+            self.assertEqual(_plain(getattr(streamed, name)), _plain(getattr(expected, name)), name)
+        self.assertEqual(streamed.as_dict(), expected.as_dict())
+
+    def test_compact_body(self):
+        body = json.dumps(RESPONSE, separators=(",", ":"))
+        self.assertSameReading(body, keep_forecast=False)
+        self.assertSameReading(body, keep_forecast=True)
+
+    def test_pretty_printed_body(self):
+        body = json.dumps(RESPONSE, indent=2, ensure_ascii=False)
+        self.assertSameReading(body, keep_forecast=False)
+        self.assertSameReading(body, keep_forecast=True)
+
+    def test_reordered_keys_and_whitespace(self):
+        reordered = {key: RESPONSE[key] for key in ("forecast", "extra", "history", "current")}
+        body = " \n" + json.dumps(reordered, indent="\t").replace(": ", " :\r\n ") + "\n "
+        self.assertSameReading(body, keep_forecast=True)
+
+    def test_on_entry_sees_every_entry(self):
+        seen = []
+        bot.scan_airly_response(118480, json.dumps(RESPONSE, indent=2),
+                                on_entry=lambda section, item: seen.append(section))
+        self.assertEqual(seen.count("current"), 1)
+        self.assertEqual(seen.count("history"), len(RESPONSE["history"]))
+        self.assertEqual(seen.count("forecast"), len(RESPONSE["forecast"]))
+
+if __name__ == "__main__":
+    unittest.main()